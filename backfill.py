@@ -0,0 +1,144 @@
+#!/usr/bin/env python3.5
+
+# backfill.py: Load PvP kills from old EQ logs into the leaderboard database.
+#
+# Usage: ./backfill.py [--processes N] /path/to/everquest/Logs/eqlog_*.txt
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import pvp
+import re
+import time
+
+_logger = logging.getLogger("backfill")
+
+# Same as pvp._PVP_RE, but on raw bytes, anchored to the start of a log line, and never running
+# past the end of a line.
+_PVP_LINE_RE = re.compile(rb"^\[([^\]\n]*)\] \[PvP\] ([A-Za-z]+) <([^>\n]*)> has been defeated by "
+                          rb"([A-Za-z]+) <([^>\n]*)> in ([^!\n]+)!", re.M)
+
+_CHUNK_SIZE = 16 << 20
+_BATCH_SIZE = 50000
+
+
+def _chunks(filenames: [str], chunk_size: int):
+    """Split files into (filename, start, end) byte ranges for the workers"""
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        for start in range(0, size, chunk_size):
+            yield filename, start, min(size, start + chunk_size)
+
+
+def _parse_chunk(chunk):
+    """Find the kills in the lines starting within a byte range of a log file.  Returns the number
+    of lines scanned, and a list of (timestamp, winner, winner_guild, loser, loser_guild, zone)."""
+    filename, start, end = chunk
+    with open(filename, "rb") as infile:
+        if start > 0:
+            # The line straddling our start belongs to the previous chunk.
+            infile.seek(start - 1)
+            infile.readline()
+        data = infile.read(max(0, end - infile.tell()))
+        if data and not data.endswith(b"\n"):
+            data += infile.readline()
+
+    kills = []
+    stamps = {}
+    for m in _PVP_LINE_RE.finditer(data):
+        stamp = m.group(1)
+        timestamp = stamps.get(stamp)
+        if timestamp is None:
+            try:
+                timestamp = datetime.datetime.strptime(str(stamp, "latin-1"), "%a %b %d %H:%M:%S %Y").isoformat()
+            except ValueError:
+                continue
+            stamps[stamp] = timestamp
+        loser, loser_guild, winner, winner_guild, zone = [str(g, "latin-1") for g in m.groups()[1:]]
+        kills.append((timestamp, winner.lower(), winner_guild, loser.lower(), loser_guild, zone))
+    return data.count(b"\n"), kills
+
+
+def _existing_kills() -> set:
+    """Keys of the kills already in the database, in the same form _kill_key produces"""
+    keys = set()
+    cursor = pvp._DB.cursor()
+    try:
+        cursor.execute("SELECT timestamp, winner, loser, zone FROM kills")
+        for timestamp, winner, loser, zone in cursor.fetchall():
+            keys.add((timestamp, winner, loser, zone))
+            if "." in timestamp:
+                # Recorded live with the bot's clock rather than the log's, so it could be up to
+                # a second after the logged time.
+                ts = datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+                keys.add((ts.isoformat(), winner, loser, zone))
+                keys.add(((ts - datetime.timedelta(seconds=1)).isoformat(), winner, loser, zone))
+        return keys
+    finally:
+        cursor.close()
+
+
+def _kill_key(kill) -> tuple:
+    """The same kill seen from several characters' logs has the same key"""
+    return kill[0], kill[1], kill[3], kill[5]
+
+
+def _insert_batch(kills: [tuple]):
+    pvp._DB.executemany("INSERT INTO kills(timestamp, winner, winner_guild, loser, loser_guild, zone) VALUES (?,?,?,?,?,?)",
+                        kills)
+    pvp._DB.commit()
+
+
+def backfill(filenames: [str], processes: int = None, chunk_size: int = _CHUNK_SIZE, batch_size: int = _BATCH_SIZE):
+    """Scan log files for kills, add any we don't already have, then rebuild the scores."""
+    pvp._open_db()
+    seen = _existing_kills()
+    _logger.info("%d kills already recorded" % len(seen))
+
+    started = time.time()
+    lines = 0
+    nbytes = 0
+    found = 0
+    pending = []
+    inserted = 0
+    with multiprocessing.Pool(processes) as pool:
+        chunks = list(_chunks(filenames, chunk_size))
+        for chunk, (nlines, kills) in zip(chunks, pool.imap(_parse_chunk, chunks)):
+            lines += nlines
+            nbytes += chunk[2] - chunk[1]
+            found += len(kills)
+            for kill in kills:
+                key = _kill_key(kill)
+                if key not in seen:
+                    seen.add(key)
+                    pending.append(kill)
+            if len(pending) >= batch_size:
+                _insert_batch(pending)
+                inserted += len(pending)
+                pending = []
+            elapsed = max(time.time() - started, 1e-6)
+            _logger.info("%s: %d lines (%.0f lines/s, %.1f MB/s), %d kills found, %d new" % (
+                os.path.basename(chunk[0]), lines, lines / elapsed, nbytes / elapsed / 1e6, found, inserted + len(pending)))
+    if pending:
+        _insert_batch(pending)
+        inserted += len(pending)
+    elapsed = max(time.time() - started, 1e-6)
+    _logger.info("Scanned %d lines in %.1fs (%.0f lines/s); %d kills found, %d new" % (
+        lines, elapsed, lines / elapsed, found, inserted))
+
+    if inserted:
+        pvp._rebuild_scores()
+    pvp._DB.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s | %(name)s | %(msg)s")
+    parser = argparse.ArgumentParser(description="Load PvP kills from old EQ logs into the leaderboard database")
+    parser.add_argument("--processes", type=int, default=None, help="parser processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=_CHUNK_SIZE, help="bytes of log per parser task")
+    parser.add_argument("--batch-size", type=int, default=_BATCH_SIZE, help="kills per database transaction")
+    parser.add_argument("logs", nargs="+", help="eqlog_*.txt files")
+    args = parser.parse_args()
+    backfill(args.logs, args.processes, args.chunk_size, args.batch_size)
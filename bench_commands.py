@@ -0,0 +1,107 @@
+#!/usr/bin/env python3.5
+
+# bench_commands.py: Benchmark EQ command throughput and latency against the simulator (see
+# eqsim.py), with the real eqlog, eqcmd, who and friends modules.  Runs headless.
+#
+# A number of clients issue /who all and /friends queries back to back, while the simulator
+# writes background traffic into the log.
+#
+# Usage: ./bench_commands.py --clients 4 --duration 30 --rate 200
+
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+
+# The bot's modules keep their databases in $HOME, and find xdotool through R99_XDOTOOL, so set
+# both up before importing them.
+os.environ["HOME"] = tempfile.mkdtemp(prefix="r99bench")
+_EQDIR = os.path.join(os.environ["HOME"], "eq")
+os.environ["R99_XDOTOOL"] = os.path.join(_EQDIR, "xdotool")
+os.environ.setdefault("DISPLAY", ":99")
+
+import eqcmd
+import eqlog
+import eqsim
+import friends
+import who
+
+
+def _pct(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100))]
+
+
+async def _client(sim, n, until, latencies, failures):
+    """Issue queries until time runs out: mostly /who all for somebody online, sometimes /friends"""
+    i = 0
+    while time.monotonic() < until:
+        i += 1
+        started = time.monotonic()
+        try:
+            if i % 5 == 0:
+                result = await friends._friends()
+            else:
+                name = sorted(sim.players)[(n * 7919 + i) % len(sim.players)]
+                result = await who.who_all(name, eqcmd.INTERACTIVE, 30, max_age=0)
+        except eqcmd.CommandError:
+            result = None
+        if result is None:
+            failures.append(time.monotonic() - started)
+        else:
+            latencies.append(time.monotonic() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark EQ commands against the simulator")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients issuing commands")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--rate", type=float, default=200, help="background log lines per second")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean seconds for EQ to answer a command")
+    parser.add_argument("--friends", type=int, default=20, help="friends to add before starting")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+
+    sim = eqsim.Simulator(_EQDIR, latency=args.latency, rate=args.rate, seed=args.seed)
+    await sim.start()
+    await eqlog.init(_EQDIR)
+    eqlog.start()
+    await eqcmd.init()
+    started = time.monotonic()
+    await eqcmd.wait_for_ready()
+    print("ready after:       %.2fs" % (time.monotonic() - started))
+
+    started = time.monotonic()
+    await friends._toggle_friends(sorted(sim.players)[:args.friends])
+    print("%d friends added:  %.2fs" % (len(sim.friends), time.monotonic() - started))
+
+    latencies = []
+    failures = []
+    started = time.monotonic()
+    until = started + args.duration
+    await asyncio.wait([asyncio.ensure_future(_client(sim, n, until, latencies, failures))
+                        for n in range(args.clients)])
+    elapsed = time.monotonic() - started
+    await sim.stop()
+
+    print("commands:          %d ok, %d failed in %.1fs (%.2f/s)" % (
+        len(latencies), len(failures), elapsed, len(latencies) / elapsed))
+    print("latency:           p50 %.2fs  p99 %.2fs  max %.2fs" % (
+        _pct(latencies, 50), _pct(latencies, 99), _pct(latencies, 100)))
+    print("peak RSS:          %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    for stats in eqcmd.transaction_stats():
+        print("transaction %-8s %d runs, %d timeouts, mean %.2fs, max %.2fs" % (
+            stats["name"], stats["runs"], stats["timeouts"],
+            stats["latency"] / max(1, stats["runs"] - stats["timeouts"]), stats["max_latency"]))
+    for stats in eqcmd.scheduler_stats():
+        print("priority %-11s %d runs, %d expired, max wait %.2fs, max run %.2fs" % (
+            stats["priority"], stats["runs"], stats["expired"], stats["max_wait"], stats["max_run"]))
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
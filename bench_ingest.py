@@ -0,0 +1,114 @@
+#!/usr/bin/env python3.5
+
+# bench_ingest.py: Benchmark log ingestion, from eqlog through LogTap fan-out to the pvp and
+# chat_forward consumers.
+#
+# A synthetic log (see eqloggen.py) is written at a fixed rate into a scratch EQ directory, and
+# the real eqlog, chat_forward and pvp modules run against it, with spam.send replaced by a
+# recorder so that nothing goes to Discord.  Runs headless.
+#
+# Usage: ./bench_ingest.py --rate 500 --duration 20
+
+import argparse
+import asyncio
+import os
+import re
+import resource
+import tempfile
+import time
+
+# The bot's modules keep their databases in $HOME, so point that somewhere disposable before
+# importing them.
+os.environ["HOME"] = tempfile.mkdtemp(prefix="r99bench")
+
+import chat_forward
+import eqlog
+import eqloggen
+import pvp
+import spam
+
+_SEQ_RE = re.compile(r"#([0-9]+)")
+
+
+class _Recorder(object):
+    """Stands in for spam.send, and matches what comes out with what was written."""
+
+    def __init__(self):
+        self.pending = {}
+        self.latencies = []
+        self.expected = 0
+
+    def on_write(self, kind, seq, when):
+        self.pending[seq] = when
+        self.expected += 1
+
+    async def send(self, content=None, embed=None, **kwargs):
+        now = time.monotonic()
+        text = content if content is not None else embed.description
+        m = _SEQ_RE.search(text)
+        if m:
+            when = self.pending.pop(int(m.group(1)), None)
+            if when is not None:
+                self.latencies.append(now - when)
+
+
+async def _lag_monitor(samples: list, interval: float = 0.01):
+    """Measure how late the event loop wakes us up"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+
+def _pct(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark eqlog ingestion and tap fan-out")
+    parser.add_argument("--rate", type=float, default=500, help="log lines written per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to write for")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for consumers to catch up")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the generated traffic")
+    args = parser.parse_args()
+
+    eqdir = os.path.join(os.environ["HOME"], "eq")
+    os.makedirs(os.path.join(eqdir, "Logs"))
+    logfile = os.path.join(eqdir, "Logs", "eqlog_Bench_P1999PVP.txt")
+    open(logfile, "w").close()
+
+    recorder = _Recorder()
+    spam.send = recorder.send
+    await eqlog.init(eqdir)
+    await chat_forward.init()
+    await pvp.init()
+    eqlog.start()
+    lag = []
+    monitor = asyncio.ensure_future(_lag_monitor(lag))
+    await asyncio.sleep(0.5)
+
+    started = time.monotonic()
+    written = await eqloggen.LogGenerator(seed=args.seed).run(logfile, args.rate, args.duration, recorder.on_write)
+    deadline = time.monotonic() + args.drain
+    while recorder.pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - started
+    monitor.cancel()
+
+    print("lines written:     %d in %.1fs (%.0f lines/s)" % (written, elapsed, written / elapsed))
+    print("delivered:         %d of %d sequenced lines" % (len(recorder.latencies), recorder.expected))
+    print("latency:           p50 %.2f ms  p99 %.2f ms  max %.2f ms" % (
+        1000*_pct(recorder.latencies, 50), 1000*_pct(recorder.latencies, 99), 1000*_pct(recorder.latencies, 100)))
+    print("event loop lag:    p50 %.2f ms  p99 %.2f ms  max %.2f ms" % (
+        1000*_pct(lag, 50), 1000*_pct(lag, 99), 1000*_pct(lag, 100)))
+    print("peak RSS:          %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    for stats in eqlog.tap_stats():
+        print("tap %-14s high water %d, dropped %d" % (stats["name"], stats["high_water"], stats["dropped"]))
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3.5
+
+# bench_tail.py: Compare polling and inotify log tailing: idle wakeups per second, and latency
+# from a line being written to it arriving on the tail queue.
+
+import argparse
+import asyncio
+import eqlog
+import inotify
+import os
+import tempfile
+import time
+
+
+async def _idle_wakeups(filename, duration):
+    """Count how often the tail wakes up while nothing is being written"""
+    q = asyncio.Queue()
+    task = asyncio.ensure_future(eqlog._tail(filename, q))
+    await asyncio.sleep(0.5)
+    start = eqlog._TAIL_WAKEUPS
+    await asyncio.sleep(duration)
+    wakeups = eqlog._TAIL_WAKEUPS - start
+    task.cancel()
+    await asyncio.wait([task])
+    return wakeups / duration
+
+
+async def _latencies(filename, count, interval):
+    """Write lines at a steady rate and measure how long each takes to come out of the tail"""
+    q = asyncio.Queue()
+    task = asyncio.ensure_future(eqlog._tail(filename, q))
+    await asyncio.sleep(0.5)
+    latencies = []
+    with open(filename, "a") as outfile:
+        for i in range(count):
+            outfile.write("[Sat Apr 14 08:56:08 2018] bench %.9f\n" % time.monotonic())
+            outfile.flush()
+            line = (await q.get())[-1]
+            latencies.append(time.monotonic() - float(line.split()[-1]))
+            await asyncio.sleep(interval)
+    task.cancel()
+    await asyncio.wait([task])
+    latencies.sort()
+    return latencies
+
+
+def _pct(values, p):
+    return values[min(len(values)-1, int(len(values)*p/100))]
+
+
+async def _run(mode, args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "eqlog_Bench_P1999PVP.txt")
+        with open(filename, "w") as outfile:
+            outfile.write("[Sat Apr 14 08:56:08 2018] start\n")
+        eqlog._INOTIFY = inotify.Inotify() if mode == "inotify" else None
+        try:
+            rate = await _idle_wakeups(filename, args.idle)
+            latencies = await _latencies(filename, args.lines, args.interval)
+        finally:
+            if eqlog._INOTIFY is not None:
+                eqlog._INOTIFY.close()
+                eqlog._INOTIFY = None
+    print("%-8s idle wakeups/s: %6.2f   latency p50: %6.2f ms  p99: %6.2f ms  max: %6.2f ms" % (
+        mode, rate, 1000*_pct(latencies, 50), 1000*_pct(latencies, 99), 1000*latencies[-1]))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark eqlog tailing")
+    parser.add_argument("--idle", type=float, default=5, help="seconds to count idle wakeups over")
+    parser.add_argument("--lines", type=int, default=200, help="lines to write for the latency test")
+    parser.add_argument("--interval", type=float, default=0.013, help="seconds between written lines")
+    args = parser.parse_args()
+    modes = ["poll"]
+    if inotify.available():
+        modes.append("inotify")
+    for mode in modes:
+        await _run(mode, args)
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -9,19 +9,20 @@ import chat_forward
 import conf
 import friends
 import spam
+import state
 import pvp
 import os
 
 _logger = logging.getLogger("botmain")
 
 
-_SHOULD_DIE = False
+_SHOULD_DIE = asyncio.Event()
 
 
 async def _timer():
-    global _SHOULD_DIE
     await asyncio.sleep(conf.RELOG_DURATION)
-    _SHOULD_DIE = True
+    _logger.info("Time to relog")
+    _SHOULD_DIE.set()
 
 
 async def main():
@@ -33,6 +34,7 @@ async def main():
     _logger.info("Initializing eqcmd")
     await eqcmd.init()
     await eqcmd.wait_for_ready()
+    eqcmd.add_unready_listener(_SHOULD_DIE.set)
 
     _logger.info("Connecting to discord")
     await chat.init(conf.TOKEN)
@@ -43,13 +45,17 @@ async def main():
     await friends.init()
     await pvp.init()
 
+    _logger.info("Dispatching log lines")
+    eqlog.start()
+
     try:
-        while eqcmd.is_ready() and not _SHOULD_DIE:
-            await asyncio.sleep(1)
+        await _SHOULD_DIE.wait()
     except:
         _logger.error("Unexpected error", exc_info=True)
     finally:
         _logger.fatal("Dieing now", exc_info=True)
+        eqlog.checkpoint()
+        state.flush()
         os._exit(1)
 
 
@@ -7,23 +7,26 @@ import logging
 import contextlib
 import misc
 import os
+import time
 
 
-lock = asyncio.Lock()
 _client = None
 _logger = logging.getLogger("chat")
 _chatqueue = asyncio.Queue()
 
+# Default bound on the number of messages queued up for a single tap.
+TAP_MAXSIZE = 100
+
 
 class ChatTap(object):
     """A context object which holds a queue of messages from the Discord chat."""
     _INSTANCE_COUNTER = 0
     _ACTIVE = set()
 
-    def __init__(self):
+    def __init__(self, name: str = None, maxsize: int = TAP_MAXSIZE, policy: str = misc.DROP_OLDEST):
         self._id = ChatTap._INSTANCE_COUNTER
         ChatTap._INSTANCE_COUNTER += 1
-        self._queue = asyncio.Queue()
+        self._queue = misc.TapQueue(name if name is not None else "chattap#%d" % self._id, maxsize, policy)
         ChatTap._ACTIVE.add(self)
 
     def __hash__(self):
@@ -38,58 +41,200 @@ class ChatTap(object):
     async def next_message(self) -> discord.Message:
         return await self._queue.get()
 
+    def stats(self) -> dict:
+        """Queue depth, high water mark and dropped message count for this tap"""
+        return self._queue.stats()
+
     def close(self):
         ChatTap._ACTIVE.remove(self)
 
 
 @contextlib.contextmanager
-def tap() -> ChatTap:
-    """Return a ChatTap object which can be used to receive Discord lines."""
-    ct = ChatTap()
+def tap(name: str = None, maxsize: int = TAP_MAXSIZE, policy: str = misc.DROP_OLDEST) -> ChatTap:
+    """Return a ChatTap object which can be used to receive Discord lines.  See eqlog.tap for the
+    meaning of maxsize and policy."""
+    ct = ChatTap(name, maxsize, policy)
     try:
         yield ct
     finally:
         ct.close()
 
 
+def tap_stats() -> [dict]:
+    """Get queue statistics for all active taps"""
+    return [instance.stats() for instance in ChatTap._ACTIVE]
+
+
+class _TokenBucket(object):
+    """Allows rate operations per second on average, in bursts of up to burst"""
+    __slots__ = ['rate', 'burst', '_tokens', '_updated']
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until an operation is allowed, and count it"""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Discord's documented limits: 5 messages per 5 seconds and 5 deletes per second in each channel,
+# and 50 requests per second overall.
+_ROUTE_LIMITS = {"send": (1, 5), "delete": (5, 5)}
+_GLOBAL_BUCKET = _TokenBucket(50, 50)
+
+# A channel's sender goes away after this many idle seconds, and is restarted when needed.
+_SENDER_IDLE = 60
+
+# At most this many requests are in flight to Discord at once, across all channels.
+MAX_CONCURRENT_SENDS = 10
+_IN_FLIGHT = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+
+class _Outbox(object):
+    """Requests waiting to go to one Discord channel (or user), carried out in order by a sender of
+    its own, at the channel's rate limits.  Slow or throttled channels don't hold up the others."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._queue = asyncio.Queue()
+        self._buckets = dict((route, _TokenBucket(rate, burst)) for route, (rate, burst) in _ROUTE_LIMITS.items())
+        self._sender = None
+        self._stats = {"name": name, "depth": 0, "high_water": 0, "sent": 0, "errors": 0,
+                       "latency": 0.0, "max_latency": 0.0}
+
+    def submit(self, route: str, fn, *args, **kwargs) -> asyncio.Future:
+        """Queue up fn(*args, **kwargs) on a route, and return a future for its result"""
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((route, fn, args, kwargs, future, time.monotonic()))
+        self._stats["high_water"] = max(self._stats["high_water"], self._queue.qsize())
+        if self._sender is None:
+            self._sender = asyncio.ensure_future(self._send_loop())
+        return future
+
+    async def _send_loop(self):
+        while True:
+            try:
+                route, fn, args, kwargs, future, queued_at = await asyncio.wait_for(self._queue.get(), _SENDER_IDLE)
+            except asyncio.TimeoutError:
+                if self._queue.empty():
+                    self._sender = None
+                    return
+                continue
+            if future.cancelled():
+                continue
+            await self._buckets[route].acquire()
+            await _GLOBAL_BUCKET.acquire()
+            try:
+                async with _IN_FLIGHT:
+                    result = await fn(*args, **kwargs)
+            except Exception as e:
+                self._stats["errors"] += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+                continue
+            latency = time.monotonic() - queued_at
+            self._stats["sent"] += 1
+            self._stats["latency"] += latency
+            self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+            if not future.cancelled():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        return stats
+
+
+_OUTBOXES = {}
+
+
+async def _outbound(where, route: str, fn, *args, **kwargs):
+    """Carry out a Discord request through the destination's outbox"""
+    key = getattr(where, "id", None)
+    outbox = _OUTBOXES.get(key)
+    if outbox is None:
+        outbox = _OUTBOXES[key] = _Outbox(str(where))
+    return await outbox.submit(route, fn, *args, **kwargs)
+
+
+def send_stats() -> [dict]:
+    """Per destination: queue depth and high water mark, requests done and failed, and total and
+    maximum time from being queued to being done"""
+    return [outbox.stats() for outbox in _OUTBOXES.values()]
+
+
 _LAST_EXCEPTION = None
 
 
-async def delete_message(*args, **kwargs):
-    """Get exclusive control of Discord, and delete the specified message."""
+async def delete_message(msg):
+    """Delete the specified message, in turn with everything else going to its channel."""
     global _LAST_EXCEPTION
-    with await lock:
-        try:
-            return await _client.delete_message(*args, **kwargs)
-        except discord.DiscordException as e:
-            _logger.error(str(e))
-        except Exception as e:
-            _logger.error(str(e))
-            _LAST_EXCEPTION = e
+    try:
+        return await _outbound(msg.channel, "delete", _client.delete_message, msg)
+    except discord.DiscordException as e:
+        _logger.error(str(e))
+    except Exception as e:
+        _logger.error(str(e))
+        _LAST_EXCEPTION = e
+
+
+# Failures which trying again won't fix: we may not post there, or it's gone.
+_PERMANENT_ERRORS = (discord.Forbidden, discord.NotFound)
+
+
+class SendError(Exception):
+    """A message couldn't be sent.  permanent is true if sending it again can't succeed."""
+
+    def __init__(self, reason: str, permanent: bool):
+        super().__init__(reason)
+        self.permanent = permanent
 
 
 async def send_message(where, *args, **kwargs) -> discord.Message:
-    """Get exclusive control of Discord, and send a message."""
-    with await lock:
-        return await _send_message_body(where, *args, **kwargs)
+    """Send a message, in turn with everything else going to the same place.  Returns None if it
+    couldn't be sent."""
+    try:
+        return await deliver_message(where, *args, **kwargs)
+    except SendError:
+        return None
+
+
+async def deliver_message(where, *args, **kwargs) -> discord.Message:
+    """As send_message, but raise SendError if the message couldn't be sent."""
+    message = await _outbound(where, "send", _send_message_body, where, *args, **kwargs)
+    if message is None:
+        raise SendError("Timed out sending to %s" % where, False)
+    return message
 
 
 @misc.timeout(8)
 async def _send_message_body(where, *args, **kwargs):
     global _LAST_EXCEPTION
     try:
-        with tap() as ct:
-            await _client.send_message(where, *args, **kwargs)
-            while True:
-                msg = await ct.next_message()
-                if msg.author == _client.user:
-                    return msg
+        # The REST response is the message as sent, so there's no need to wait for it to come
+        # back through the gateway.
+        return await _client.send_message(where, *args, **kwargs)
 
+    except _PERMANENT_ERRORS as e:
+        _logger.error(str(e))
+        raise SendError(str(e), True)
     except discord.DiscordException as e:
         _logger.error(str(e))
+        raise SendError(str(e), False)
     except Exception as e:
         _logger.error(str(e))
         _LAST_EXCEPTION = e
+        raise SendError(str(e), False)
 
 
 async def send_info(where, title, text):
@@ -131,12 +276,28 @@ async def _fade_body(msg, duration):
 
 def get_server(id) -> discord.Server:
     """Given a server id, get a Server object that we're connected to, or None"""
+    return _client.get_server(id)
+
+
+def get_servers() -> [discord.Server]:
+    """Get all the servers we're connected to"""
+    return list(_client.servers)
+
+
+def get_user(id) -> discord.Member:
+    """Given a user id, find them among the members of our servers, or None"""
     for server in _client.servers:
-        if server.id == id:
-            return server
+        member = server.get_member(id)
+        if member is not None:
+            return member
     return None
 
 
+def get_channel(id) -> discord.Channel:
+    """Given a channel id, get a Channel object that we can see, or None"""
+    return _client.get_channel(id)
+
+
 def quote(text):
     """Quote Discord's MarkDown special characters"""
     return text \
@@ -161,6 +322,9 @@ async def init(token):
         _logger.info("<%s:%s> %s: %s" % (msg.server, msg.channel, msg.author, msg.content))
         await _chatqueue.put(msg)
 
+    for event in list(_LISTENERS):
+        _install_listener(event)
+
     asyncio.ensure_future(_watch_chat())
     asyncio.ensure_future(_cmd_dispatch())
     asyncio.ensure_future(_discord_start_loop(token))
@@ -209,6 +373,36 @@ async def _watch_chat():
             await instance.post_message(msg)
 
 
+_LISTENERS = {}
+_INSTALLED = set()
+
+
+def listen(event: str):
+    """Decorator for a function to be called with the arguments of a Discord client event, e.g.
+    "on_channel_update".  It's called straight from the client, so it mustn't block."""
+    def rewrite(fn):
+        _LISTENERS.setdefault(event, []).append(fn)
+        if _client is not None:
+            _install_listener(event)
+        return fn
+    return rewrite
+
+
+def _install_listener(event: str):
+    if event in _INSTALLED:
+        return
+    _INSTALLED.add(event)
+
+    async def dispatch(*args):
+        for fn in list(_LISTENERS.get(event, ())):
+            try:
+                fn(*args)
+            except Exception:
+                _logger.error("%s listener failed" % event, exc_info=True)
+    dispatch.__name__ = event
+    _client.event(dispatch)
+
+
 _CMDS = []
 
 
@@ -232,7 +426,7 @@ def _get_cmd(name):
 
 async def _cmd_dispatch():
     """Dispatch loop for commands"""
-    with tap() as ct:
+    with tap("commands", policy=misc.BLOCK) as ct:
         while True:
             msg = await ct.next_message()
             parts = msg.content.strip().split()
@@ -5,7 +5,6 @@ import chat
 import eqlog
 import re
 import spam
-import time
 import discord
 
 
@@ -16,25 +15,24 @@ _OOC_RE = re.compile(r"([^ ]*) says out of character, '(.*)'")
 _TELL_RE = re.compile(r"([^ ]*) tells you, '(.*)'")
 _KILL_RE = re.compile(r"(Thou hast been expelled by the gods!)")
 
+
+def _dedup(event) -> str:
+    """Lines replayed from the log after a restart shouldn't be relayed twice"""
+    return "%s|%s" % (event.timestamp.isoformat(), event.text)
+
+
 async def _ooc_loop():
-    with eqlog.tap() as lt:
+    with eqlog.tap([_TELL_RE, _OOC_RE, _KILL_RE], "chat_forward") as lt:
         while True:
-            line = await lt.next_line()
-            m = _TELL_RE.match(line)
-            if m:
+            event, m = await lt.next_match()
+            if m.re is _TELL_RE:
                 msgtext = chat.quote(m.group(2))
-                fmtmsg = "\\[%s\\] **TELL** `%s`: %s" % (time.strftime("%l:%M %p").strip(), m.group(1), msgtext)
-                await spam.send(fmtmsg)
-                continue
-            m = _OOC_RE.match(line)
-            if m:
+                fmtmsg = "\\[%s\\] **TELL** `%s`: %s" % (event.timestamp.strftime("%l:%M %p").strip(), m.group(1), msgtext)
+                await spam.send(fmtmsg, dedup=_dedup(event))
+            elif m.re is _OOC_RE:
                 msgtext = chat.quote(m.group(2))
-                fmtmsg = "\\[%s\\] **OOC** `%s`: %s" % (time.strftime("%l:%M %p").strip(), m.group(1), msgtext)
-                await spam.send(fmtmsg)
-                continue
-            m = _KILL_RE.match(line)
-            if m:
-                fmtmsg = "\\[%s\\] **GM** *%s*" % (time.strftime("%l:%M %p").strip(), m.group(1))
-                await spam.send(fmtmsg)
-                continue
-
+                fmtmsg = "\\[%s\\] **OOC** `%s`: %s" % (event.timestamp.strftime("%l:%M %p").strip(), m.group(1), msgtext)
+                await spam.send(fmtmsg, dedup=_dedup(event))
+            elif m.re is _KILL_RE:
+                fmtmsg = "\\[%s\\] **GM** *%s*" % (event.timestamp.strftime("%l:%M %p").strip(), m.group(1))
+                await spam.send(fmtmsg, dedup=_dedup(event))
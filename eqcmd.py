@@ -1,12 +1,16 @@
 # eqcmd.py: Basic routines for interfacing with EQ.
 
 import asyncio
-from asyncio.subprocess import create_subprocess_shell, PIPE
+from asyncio.subprocess import PIPE
+import datetime
 import eqlog
+import heapq
+import itertools
+import logging
 import os
 import re
-import shlex
 import random
+import time
 
 
 class CommandError(Exception):
@@ -19,15 +23,30 @@ class NotReadyError(Exception):
     pass
 
 
-async def _xdotool(display, text) -> [str]:
-    """Interface with X via calls to xdotool."""
-    cmd = "/usr/bin/xdotool "+text
-    env = dict([(k, os.environ[k]) for k in os.environ])
-    env["DISPLAY"] = display
-    proc = await asyncio.create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE, env=env)
+class DeadlineError(CommandError):
+    """A request to use EQ waited too long to get its turn"""
+    pass
+
+
+_logger = logging.getLogger("eqcmd")
+
+
+# R99_XDOTOOL can point somewhere else, e.g. at the simulator's stand-in (see eqsim.py).
+_XDOTOOL = os.environ.get("R99_XDOTOOL", "/usr/bin/xdotool")
+_XENV = None
+
+
+async def _xdotool(display, args) -> [str]:
+    """Interface with X via calls to xdotool.  xdotool runs each command in args in turn, so a
+    whole sequence of input costs one process."""
+    global _XENV
+    if _XENV is None or _XENV["DISPLAY"] != display:
+        _XENV = dict(os.environ)
+        _XENV["DISPLAY"] = display
+    proc = await asyncio.create_subprocess_exec(_XDOTOOL, *[str(arg) for arg in args],
+                                                stdout=PIPE, stderr=PIPE, env=_XENV)
     stdout, stderr = await proc.communicate()
-    rc = await proc.wait()
-    if rc != 0:
+    if proc.returncode != 0:
         raise CommandError("Command send failed")
     return str(stdout, "utf8").splitlines()
 
@@ -43,7 +62,7 @@ async def _eqdisplay() -> str:
 #        for i in range(100):
 #            try:
 #                display = ":%d" % i
-#                await _xdotool(display, "search --name EverQuest")
+#                await _xdotool(display, ["search", "--name", "EverQuest"])
 #                _EQDISPLAY = display
 #                break
 #            except CommandError:
@@ -53,18 +72,54 @@ async def _eqdisplay() -> str:
 #    return _EQDISPLAY
 
 
-async def _eqxdo(text):
+async def _eqxdo(*args):
     """Run xdotool against the display holding EverQuest"""
-    return await _xdotool(await _eqdisplay(), text)
+    try:
+        return await _xdotool(await _eqdisplay(), args)
+    except CommandError:
+        # Maybe EQ's window went away; look it up again next time.
+        _forget_window()
+        raise
+
+
+_EQWINDOW = None
+
+
+def _forget_window():
+    global _EQWINDOW
+    _EQWINDOW = None
+
+
+async def _eqwindow() -> int:
+    """Get the X window id of EverQuest.  Looked up once, then remembered."""
+    global _EQWINDOW
+    if _EQWINDOW is None:
+        lines = await _eqxdo("search", "--name", "EverQuest")
+        if not lines:
+            raise CommandError("Couldn't find EverQuest window")
+        _EQWINDOW = int(lines[0])
+    return _EQWINDOW
+
+
+class _XBatch(object):
+    """A sequence of xdotool commands to be sent to X in one go."""
+
+    def __init__(self):
+        self._args = []
+
+    def add(self, *args):
+        self._args.extend(args)
+        return self
+
+    async def run(self) -> [str]:
+        return await _eqxdo(*self._args)
 
 
 _WINDLOC_RE = re.compile(r"\s*Position: ([0-9]+),([0-9]+).*")
 _GEOMETRY_RE = re.compile(r"\s*Geometry: ([0-9]+)x([0-9]+).*")
 
 
-async def _geometry():
-    """Get the EQ window location"""
-    lines = await _eqxdo("search --name EverQuest getwindowgeometry")
+def _parse_geometry(lines: [str]):
     loc = None
     size = None
     for line in lines:
@@ -79,113 +134,350 @@ async def _geometry():
     return loc, size
 
 
-async def _prepare():
-    """Prepare EQ window to receive input"""
-    loc, size = await _geometry()
-    x = loc[0] + (size[0]//3 + random.randint(0, size[0]//3))
-    y = loc[1] + (size[1]//3 + random.randint(0, size[1]//3))
-    await _eqxdo("mousemove %d %d" % (x, y))
-    await _eqxdo("click 1")
-    await asyncio.sleep(0.2)
-    await _eqxdo("search --name EverQuest windowmap windowraise windowfocus")
-    await _eqxdo("click 1")
+async def _geometry():
+    """Get the EQ window location"""
+    return _parse_geometry(await _eqxdo("getwindowgeometry", await _eqwindow()))
 
 
-async def _press_raw(key_name):
-    """Press a key in EQ"""
-    await _eqxdo("key " + shlex.quote(key_name))
-    await asyncio.sleep(0.2)
+# Cleared if getactivewindow fails, e.g. under a window manager without _NET_ACTIVE_WINDOW, after
+# which focus is never assumed.
+_ACTIVE_WINDOW_KNOWN = True
 
 
-async def _press(key_name):
-    """Press a key in EQ after preparing for input"""
-    await _prepare()
-    await _press_raw(key_name)
+async def _focus_state():
+    """Find out which window has focus, and where the EQ window is, in one go.  The active
+    window is None if it couldn't be determined."""
+    global _ACTIVE_WINDOW_KNOWN
+    window = await _eqwindow()
+    if _ACTIVE_WINDOW_KNOWN:
+        try:
+            # Not through _eqxdo: this failing needn't mean that EQ's window has gone.
+            lines = await _xdotool(await _eqdisplay(), ["getactivewindow", "getwindowgeometry", window])
+        except CommandError:
+            geometry = await _geometry()
+            # The window's still there, so it's getactivewindow that doesn't work.
+            _logger.warning("Can't tell which window has focus; focusing EQ before every command")
+            _ACTIVE_WINDOW_KNOWN = False
+            return None, geometry
+        active = int(lines[0]) if lines and lines[0].isdigit() else None
+        return active, _parse_geometry(lines[1:])
+    return None, await _geometry()
+
+
+class _Pacing(object):
+    """How long to let keystrokes settle, and how fast to type.  These start at values known to
+    work, then adapt: the settle time tracks how quickly EQ responds to commands, and typing
+    speeds up while responses show that commands were typed correctly, and backs off when one
+    goes unanswered."""
+    MIN_SETTLE = 0.05
+    MAX_SETTLE = 1.0
+    MIN_TYPE_DELAY = 12
+    MAX_TYPE_DELAY = 60
 
+    def __init__(self):
+        self.settle = 0.2
+        self.type_delay = 20
 
-async def _type(text):
-    """Type a line of text in EQ"""
-    await _prepare()
-    await _press_raw("Return")
-    await _eqxdo("type --delay 20 "+shlex.quote(text))
-    await _press_raw("Return")
+    def observe_response(self, latency: float):
+        """A command got its first response latency seconds after it was entered"""
+        target = min(self.MAX_SETTLE, max(self.MIN_SETTLE, latency / 2))
+        self.settle = 0.8 * self.settle + 0.2 * target
 
+    def observe_confirmed(self):
+        """A command's response showed that it was typed correctly.  Any response at all won't do:
+        a garbled /who all still gets an answer."""
+        self.type_delay = max(self.MIN_TYPE_DELAY, self.type_delay - 1)
 
-async def _expect_io():
-    """Wait until a line of text comes in from the EQ log."""
-    try:
-        with eqlog.tap() as t:
-            await t.next_line()
-    except asyncio.CancelledError:
-        pass
+    def observe_timeout(self):
+        """A command got no response at all"""
+        self.settle = min(self.MAX_SETTLE, self.settle * 1.5)
+        self.type_delay = min(self.MAX_TYPE_DELAY, self.type_delay + 10)
 
 
-_EQ_READY = False
+_PACING = _Pacing()
 
+# Geometry of the EQ window when we last gave it focus, or None if we may have lost it since.
+_PREPARED_GEOMETRY = None
 
-async def _ping_watch():
-    """Keep the _EQ_READY variable up to date.  Here, we decide EQ is up and running if
-    we've seen at least 1 chat message (e.g. "You are out of food and drink.") sometime
-    in the past minute."""
-    global _EQ_READY
-    while True:
-        f = asyncio.ensure_future(_expect_io())
-        try:
-            await asyncio.wait_for(f, 60)
-            _EQ_READY = True
-        except asyncio.TimeoutError:
-            _EQ_READY = False
+
+def _suspect_focus():
+    """Do the full preparation before the next input, e.g. because a command went unanswered"""
+    global _PREPARED_GEOMETRY
+    _PREPARED_GEOMETRY = None
+
+
+async def _prepare(batch: _XBatch):
+    """Add input to a batch which prepares the EQ window to receive input.  If EQ still has focus
+    and hasn't moved since last time, there's nothing to do."""
+    global _PREPARED_GEOMETRY
+    active, geometry = await _focus_state()
+    window = await _eqwindow()
+    if active == window and geometry == _PREPARED_GEOMETRY:
+        return
+    loc, size = geometry
+    x = loc[0] + (size[0]//3 + random.randint(0, size[0]//3))
+    y = loc[1] + (size[1]//3 + random.randint(0, size[1]//3))
+    batch.add("mousemove", x, y, "click", 1, "sleep", _PACING.settle)
+    batch.add("windowmap", window, "windowraise", window, "windowfocus", window, "click", 1)
+    _PREPARED_GEOMETRY = geometry
+
+
+async def _press(key_name):
+    """Press a key in EQ after preparing for input"""
+    batch = _XBatch()
+    await _prepare(batch)
+    await batch.add("key", key_name).run()
+    await asyncio.sleep(_PACING.settle)
+
+
+async def _type(text):
+    """Type a line of text in EQ"""
+    batch = _XBatch()
+    await _prepare(batch)
+    # xdotool's type swallows every argument after it, so it has to be last in a batch.
+    await batch.add("key", "Return", "sleep", _PACING.settle, "type", "--delay", _PACING.type_delay, text).run()
+    await _XBatch().add("key", "Return").run()
+
+
+async def _type_lines(texts: [str]):
+    """Type several lines of text in EQ, one after another, preparing the window only once"""
+    batch = _XBatch()
+    await _prepare(batch)
+    for text in texts:
+        await batch.add("key", "Return", "sleep", _PACING.settle, "type", "--delay", _PACING.type_delay, text).run()
+        # Enter this line along with starting the next.
+        batch = _XBatch().add("key", "Return", "sleep", _PACING.settle)
+    await _XBatch().add("key", "Return").run()
+
+
+# EQ counts as up and running if it has logged something (e.g. "You are out of food and drink.")
+# within this many seconds.
+READY_WINDOW = 60
+
+
+class _Readiness(object):
+    """Whether EQ is ready to receive commands, kept up to date from the log dispatcher.  Every
+    line just notes the time; a single timer checks for silence once per window."""
+
+    def __init__(self, window: float = READY_WINDOW):
+        self.window = window
+        self._loop = asyncio.get_event_loop()
+        self._ready = asyncio.Event()
+        self._last_line = None
+        self._expiry = None
+        self._unready_listeners = []
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def wait(self):
+        await self._ready.wait()
+
+    def add_unready_listener(self, callback):
+        """Have callback() called whenever EQ stops being ready"""
+        self._unready_listeners.append(callback)
+
+    def remove_unready_listener(self, callback):
+        if callback in self._unready_listeners:
+            self._unready_listeners.remove(callback)
+
+    def on_line(self, event: eqlog.LogEvent):
+        if self._ready.is_set():
+            self._last_line = self._loop.time()
+            return
+        # Lines replayed from before we started say nothing about whether EQ is up now.
+        if (datetime.datetime.now() - event.timestamp).total_seconds() > self.window:
+            return
+        self._last_line = self._loop.time()
+        _logger.info("EQ is ready")
+        self._ready.set()
+        self._expiry = self._loop.call_at(self._last_line + self.window, self._check)
+
+    def _check(self):
+        deadline = self._last_line + self.window
+        if deadline > self._loop.time():
+            self._expiry = self._loop.call_at(deadline, self._check)
+            return
+        self._expiry = None
+        _logger.warning("Nothing from EQ for %gs; EQ is not ready" % self.window)
+        self._ready.clear()
+        for callback in list(self._unready_listeners):
+            try:
+                callback()
+            except Exception:
+                _logger.error("Unready listener failed", exc_info=True)
+
+
+_READINESS = None
 
 
 def is_ready():
     """Determine if EQ is ready to receive commands"""
-    return _EQ_READY
+    return _READINESS is not None and _READINESS.is_ready()
 
 
 async def wait_for_ready():
     """Wait for EQ to be ready to receive commands"""
-    while True:
-        if is_ready():
-            return
-        else:
-            await asyncio.sleep(1)
+    await _READINESS.wait()
+
+
+def add_unready_listener(callback):
+    """Have callback() called whenever EQ stops being ready to receive commands"""
+    _READINESS.add_unready_listener(callback)
+
+
+def remove_unready_listener(callback):
+    _READINESS.remove_unready_listener(callback)
 
 _is_init = False
 
 
 async def init():
     """Prepare the EQ command subsytem"""
-    global _is_init
+    global _is_init, _READINESS
     if _is_init:
         return
     _is_init = True
+    _READINESS = _Readiness()
+    eqlog.add_line_listener(_READINESS.on_line)
     await _eqdisplay()
-    asyncio.ensure_future(_ping_watch())
+
+
+# Priority classes for using EQ, most urgent first.
+INTERACTIVE = 0
+BACKGROUND = 1
+MAINTENANCE = 2
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", MAINTENANCE: "maintenance"}
+
+
+class _Request(object):
+    """A request for exclusive use of EQ"""
+    __slots__ = ['priority', 'name', 'future', 'queued_at', 'started_at', 'expiry']
+
+    def __init__(self, priority: int, name: str):
+        self.priority = priority
+        self.name = name
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.expiry = None
+
+
+class _Scheduler(object):
+    """Hands out exclusive use of EQ one request at a time, most urgent priority class first and
+    first come first served within a class.  Requests whose deadline passes while they wait are
+    failed with DeadlineError rather than run late."""
+
+    def __init__(self):
+        self._current = None
+        self._waiting = []
+        self._seq = itertools.count()
+        self._stats = dict((priority, {"priority": name, "runs": 0, "expired": 0, "wait": 0.0, "max_wait": 0.0,
+                                       "run": 0.0, "max_run": 0.0})
+                           for priority, name in _PRIORITY_NAMES.items())
+
+    async def acquire(self, priority: int, max_wait: float, name: str) -> _Request:
+        request = _Request(priority, name)
+        heapq.heappush(self._waiting, (priority, next(self._seq), request))
+        if self._current is None:
+            self._dispatch()
+        if max_wait is not None and not request.future.done():
+            request.expiry = asyncio.get_event_loop().call_later(max_wait, self._expire, request)
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if self._current is request:
+                self.release(request)
+            raise
+        return request
+
+    def release(self, request: _Request):
+        """Finish with EQ, and hand it on to the next request"""
+        if self._current is not request:
+            return
+        elapsed = time.monotonic() - request.started_at
+        stats = self._stats[request.priority]
+        stats["run"] += elapsed
+        stats["max_run"] = max(stats["max_run"], elapsed)
+        _logger.debug("%s: waited %.2fs, ran %.2fs" % (request.name, request.started_at - request.queued_at, elapsed))
+        self._current = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start the most urgent request that's still waiting"""
+        while self._waiting:
+            priority, seq, waiting = heapq.heappop(self._waiting)
+            if not waiting.future.done():
+                self._start(waiting)
+                break
+
+    def _start(self, request: _Request):
+        if request.expiry is not None:
+            request.expiry.cancel()
+        request.started_at = time.monotonic()
+        waited = request.started_at - request.queued_at
+        stats = self._stats[request.priority]
+        stats["runs"] += 1
+        stats["wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        self._current = request
+        request.future.set_result(None)
+
+    def _expire(self, request: _Request):
+        if not request.future.done():
+            self._stats[request.priority]["expired"] += 1
+            request.future.set_exception(DeadlineError("%s waited too long for EQ" % request.name))
+
+    def stats(self) -> [dict]:
+        return [dict(self._stats[priority]) for priority in sorted(self._stats)]
+
+
+_SCHEDULER = _Scheduler()
+
+
+def scheduler_stats() -> [dict]:
+    """Per priority class: requests run and expired, and total/maximum time spent waiting for EQ
+    and using it"""
+    return _SCHEDULER.stats()
 
 
 class CommandTap(object):
     """A context object, extending the functionality of eqlog.LogTap,
     which also allows sending commands to EQ."""
-    _LOCK = asyncio.Lock()
 
-    def __init__(self):
+    def __init__(self, request: _Request, patterns=None):
+        self._request = request
+        self._patterns = patterns
         self._ltctx = None
         self._lt = None
+        self._sent_at = None
+        self._backlog = 0
 
     def __enter__(self):
-        self._ltctx = eqlog.tap()
+        self._ltctx = eqlog.tap(self._patterns, "eqcmd:%s" % self._request.name)
         self._lt = self._ltctx.__enter__()
         return self
 
     def __exit__(self, *args):
         try:
+            if self._sent_at is not None:
+                # Nothing came back from the last command we sent.
+                _PACING.observe_timeout()
+                _suspect_focus()
             self._ltctx.__exit__(*args)
         finally:
-            CommandTap._LOCK.release()
+            _SCHEDULER.release(self._request)
 
     async def next_line(self):
         """Retrieve the next line"""
-        return await self._lt.next_line()
+        line = await self._lt.next_line()
+        if self._sent_at is not None:
+            if self._backlog > 0:
+                self._backlog -= 1
+            else:
+                _PACING.observe_response(time.monotonic() - self._sent_at)
+                self._sent_at = None
+        return line
 
     async def skip_until(self, text):
         """Wait until a line matching the specified regexp comes up"""
@@ -204,6 +496,28 @@ class CommandTap(object):
         if not is_ready():
             raise NotReadyError("EQ is not currently ready to receive commands")
         await _type(text)
+        self._sent_at = time.monotonic()
+        # Lines which arrived while we were typing can't be responses.
+        self._backlog = self._lt.stats()["depth"]
+
+    async def send_all(self, texts: [str]):
+        """Send several commands to EQ, one after another.  Quicker than sending them one at a
+        time, since the EQ window is only got ready for input once."""
+        if not is_ready():
+            raise NotReadyError("EQ is not currently ready to receive commands")
+        await _type_lines(texts)
+        self._sent_at = time.monotonic()
+        self._backlog = self._lt.stats()["depth"]
+
+    def confirmed(self):
+        """Note that the response shows the last command was typed correctly"""
+        _PACING.observe_confirmed()
+
+    def unanswered(self):
+        """Note that the last command didn't get a complete response"""
+        self._sent_at = None
+        _PACING.observe_timeout()
+        _suspect_focus()
 
     async def press(self, key_name):
         """Press a key in the EQ window."""
@@ -212,7 +526,137 @@ class CommandTap(object):
         await _press(key_name)
 
 
-async def tap():
-    """Call as 'with await eqcmd.tap() as t:' to get a CommandTap object to manipulate EQ with."""
-    await CommandTap._LOCK.acquire()
-    return CommandTap()
+async def tap(priority: int = BACKGROUND, max_wait: float = None, name: str = "command", patterns=None):
+    """Call as 'with await eqcmd.tap() as t:' to get a CommandTap object to manipulate EQ with.
+    Waits for exclusive use of EQ, behind any more urgent requests.  Raises DeadlineError if that
+    takes longer than max_wait seconds.  If patterns is given, the tap only receives matching
+    lines (see eqlog.tap)."""
+    return CommandTap(await _SCHEDULER.acquire(priority, max_wait, name), patterns)
+
+
+def _matches(pattern, line: str):
+    """Match a line against a str (exact match) or a compiled regexp.  Returns a match object,
+    the line, or None."""
+    if isinstance(pattern, str):
+        return line if line == pattern else None
+    return pattern.match(line)
+
+
+class Transaction(object):
+    """A declarative EQ command: the text to send, and how to recognise its response.  The
+    response starts once each of the start markers has been seen in turn, after which every line
+    is passed to collect (whose non-None results are gathered up) until a line matches one of the
+    end patterns.  Markers and patterns are strs, which must match a whole line, or compiled
+    regexps.  If collect is a compiled regexp, its match objects are gathered, and only lines
+    matching the markers and patterns are looked at at all.  confirm(result) says whether a
+    TransactionResult shows that the command was typed correctly; by default, seeing the start
+    markers does."""
+
+    def __init__(self, name: str, command: str, end, collect=None, start=(), timeout: float = 5,
+                 priority: int = BACKGROUND, max_wait: float = None, confirm=None):
+        self.name = name
+        self.command = command
+        self.end = list(end)
+        self.collect = collect
+        self.start = list(start)
+        self.timeout = timeout
+        self.priority = priority
+        self.max_wait = max_wait
+        self.confirm = confirm
+
+    def patterns(self):
+        """What the transaction needs to subscribe to, or None for everything"""
+        if self.collect is not None and not hasattr(self.collect, "match"):
+            return None
+        patterns = self.start + self.end
+        if self.collect is not None:
+            patterns.append(self.collect)
+        return [re.compile("^%s$" % re.escape(p)) if isinstance(p, str) else p for p in patterns]
+
+    def confirms(self, result) -> bool:
+        if self.confirm is not None:
+            return self.confirm(result)
+        return bool(self.start)
+
+    def gather(self, line: str):
+        if self.collect is None:
+            return None
+        if hasattr(self.collect, "match"):
+            return self.collect.match(line)
+        return self.collect(line)
+
+
+class TransactionResult(object):
+    """What came back from a Transaction: the collected items, and the end pattern's match"""
+    __slots__ = ['items', 'end']
+
+    def __init__(self, items: list, end):
+        self.items = items
+        self.end = end
+
+
+_TRANSACTION_STATS = {}
+
+
+def _transaction_stats(name: str) -> dict:
+    return _TRANSACTION_STATS.setdefault(name, {"name": name, "runs": 0, "timeouts": 0,
+                                                "latency": 0.0, "max_latency": 0.0})
+
+
+def count_transaction(name: str, latency: float = None):
+    """Count an exchange with EQ that doesn't go through transact() in transaction_stats: latency
+    is how long it took to get a complete response, or None if it timed out."""
+    stats = _transaction_stats(name)
+    stats["runs"] += 1
+    if latency is None:
+        stats["timeouts"] += 1
+    else:
+        stats["latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+
+
+async def transact(txn: Transaction) -> TransactionResult:
+    """Run a transaction.  EQ is held only until an end pattern matches, or until the timeout
+    runs out, in which case None is returned.  Raises NotReadyError and DeadlineError like tap()
+    and CommandTap.send."""
+    stats = _transaction_stats(txn.name)
+    with await tap(txn.priority, txn.max_wait, txn.name, txn.patterns()) as ct:
+        started = time.monotonic()
+        await ct.send(txn.command)
+        stats["runs"] += 1
+        deadline = started + txn.timeout
+        markers = list(txn.start)
+        items = []
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                line = await asyncio.wait_for(ct.next_line(), remaining)
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                _logger.warning("%s: no complete response to %r within %ss" % (txn.name, txn.command, txn.timeout))
+                ct.unanswered()
+                return None
+            if markers:
+                if _matches(markers[0], line) is not None:
+                    markers.pop(0)
+                continue
+            for pattern in txn.end:
+                m = _matches(pattern, line)
+                if m is not None:
+                    latency = time.monotonic() - started
+                    stats["latency"] += latency
+                    stats["max_latency"] = max(stats["max_latency"], latency)
+                    result = TransactionResult(items, m)
+                    if txn.confirms(result):
+                        ct.confirmed()
+                    return result
+            item = txn.gather(line)
+            if item is not None:
+                items.append(item)
+
+
+def transaction_stats() -> [dict]:
+    """Per transaction name: runs, timeouts, and total/maximum time to a complete response"""
+    return [dict(stats) for stats in _TRANSACTION_STATS.values()]
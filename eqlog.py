@@ -1,19 +1,60 @@
 import asyncio
+import collections
+import datetime
+import dbm
+import inotify
 import io
+import logging
+import misc
 import re
 import os
 import contextlib
 
+_logger = logging.getLogger("eqlog")
+
+# Default bound on the number of lines queued up for a single tap.
+TAP_MAXSIZE = 1000
+
+
+class LogEvent(object):
+    """An immutable line from an EQ log.  A single LogEvent is shared by every tap which receives
+    the line."""
+    __slots__ = ['timestamp', 'source', 'text']
+
+    def __init__(self, timestamp: datetime.datetime, source: str, text: str):
+        self.timestamp = timestamp
+        self.source = source
+        self.text = text
+
+    def __repr__(self):
+        return "LogEvent(%r, %r, %r)" % (self.timestamp, self.source, self.text)
+
+    def __str__(self):
+        return self.text
+
 
 class LogTap(object):
     _INSTANCE_COUNTER = 0
     _ACTIVE = set()
 
-    def __init__(self):
+    def __init__(self, patterns=None, name: str = None, maxsize: int = TAP_MAXSIZE, policy: str = misc.DROP_OLDEST):
         self._id = LogTap._INSTANCE_COUNTER
         LogTap._INSTANCE_COUNTER += 1
-        self._queue = asyncio.Queue()
+        self._queue = misc.TapQueue(name if name is not None else "logtap#%d" % self._id, maxsize, policy)
+        # The sequence number of the line last taken from the queue; once the consumer comes back
+        # for another, it's done with that one and everything before it.
+        self._taken = 0
+        self.handled = 0
+        self.prefixes = []
+        self.regexes = []
+        self.wants_all = patterns is None
+        for pattern in patterns or []:
+            if isinstance(pattern, str):
+                self.prefixes.append(pattern)
+            else:
+                self.regexes.append(pattern)
         LogTap._ACTIVE.add(self)
+        _ROUTER.invalidate()
 
     def __hash__(self):
         return self._id
@@ -21,96 +62,547 @@ class LogTap(object):
     def __eq__(self, other):
         return isinstance(other, LogTap) and self._id == other._id
 
-    async def post_line(self, line):
-        await self._queue.put(line)
+    async def post_event(self, event: LogEvent, match=None, seq: int = 0, block: bool = False):
+        await self._queue.put((event, match, seq), block)
+
+    async def _get(self):
+        self.handled = self._taken
+        event, match, self._taken = await self._queue.get()
+        return event, match
+
+    async def next_line(self) -> str:
+        """Wait for the text of the next line"""
+        return (await self._get())[0].text
+
+    async def next_event(self) -> LogEvent:
+        """Wait for the next line"""
+        return (await self._get())[0]
+
+    async def next_match(self):
+        """Wait for the next line, and return its LogEvent along with the match object for the
+        pattern which selected it.  The match object is None for lines selected by a literal
+        prefix, or if the tap wasn't given any patterns."""
+        return await self._get()
 
-    async def next_line(self):
-        return await self._queue.get()
+    def stats(self) -> dict:
+        """Queue depth, high water mark and dropped line count for this tap"""
+        return self._queue.stats()
 
     def close(self):
         LogTap._ACTIVE.remove(self)
+        _ROUTER.invalidate()
 
 
 @contextlib.contextmanager
-def tap() -> LogTap:
-    """Return a LogTap object which can be used to receive log lines."""
-    lt = LogTap()
+def tap(patterns=None, name: str = None, maxsize: int = TAP_MAXSIZE, policy: str = misc.DROP_OLDEST) -> LogTap:
+    """Return a LogTap object which can be used to receive log lines.  If patterns is given, it
+    should be a collection of literal prefixes (str) and compiled regexps; the tap then only gets
+    lines which start with one of the prefixes or match one of the regexps.  At most maxsize lines
+    are queued (unbounded if maxsize <= 0); policy is one of misc.BLOCK, misc.DROP_OLDEST or
+    misc.DROP_NEWEST, and says what to do when the tap's consumer falls that far behind."""
+    lt = LogTap(patterns, name, maxsize, policy)
     try:
         yield lt
     finally:
         lt.close()
 
 
-async def _tail(filename: str, q: asyncio.Queue):
-    """Watch a file, and pass all new lines to the specified queue"""
-    try:
-        with open(filename, "r") as infile:
-            infile.seek(0, io.SEEK_END)
-            infile.seek(max(0, -1+infile.tell()), io.SEEK_SET)
-            textbuf = []
-            # Await initial newline
-            while True:
-                buf = infile.read(1024)
-                if len(buf) == 0:
-                    await asyncio.sleep(0.05)
+def tap_stats() -> [dict]:
+    """Get queue statistics for all active taps"""
+    return [instance.stats() for instance in LogTap._ACTIVE]
+
+
+_LINE_LISTENERS = []
+
+
+def add_line_listener(callback):
+    """Have callback(event) called with every LogEvent, as soon as it's read.  Unlike a tap, nothing
+    is queued, so the callback must be quick and must not block."""
+    _LINE_LISTENERS.append(callback)
+
+
+def remove_line_listener(callback):
+    if callback in _LINE_LISTENERS:
+        _LINE_LISTENERS.remove(callback)
+
+
+_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+class _Router(object):
+    """Decide which taps receive a line.  Literal prefixes go into a trie, and all the regexps are
+    joined into one alternation, so that lines nobody wants are rejected in a single pass rather
+    than by every tap in turn.  Rebuilt lazily whenever the set of taps changes."""
+
+    def __init__(self):
+        self._stale = True
+        self._all = []
+        self._trie = {}
+        self._regex_taps = []
+        self._prefilter = None
+
+    def invalidate(self):
+        self._stale = True
+
+    def _rebuild(self):
+        self._all = []
+        self._trie = {}
+        self._regex_taps = []
+        for instance in LogTap._ACTIVE:
+            if instance.wants_all:
+                self._all.append(instance)
+                continue
+            for prefix in instance.prefixes:
+                node = self._trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                node.setdefault("", []).append(instance)
+            for regex in instance.regexes:
+                self._regex_taps.append((instance, regex))
+        self._prefilter = None
+        regexes = [regex for instance, regex in self._regex_taps]
+        if regexes and all(regex.flags == regexes[0].flags and not _BACKREF_RE.search(regex.pattern)
+                           for regex in regexes):
+            try:
+                self._prefilter = re.compile("|".join("(?:%s)" % regex.pattern for regex in regexes),
+                                             regexes[0].flags)
+            except re.error:
+                pass
+        self._stale = False
+
+    def route(self, line: str) -> list:
+        """Return a list of (tap, match) pairs which should receive a line"""
+        if self._stale:
+            self._rebuild()
+        routes = [(instance, None) for instance in self._all]
+        node = self._trie
+        seen = set()
+        pos = 0
+        while node is not None:
+            for instance in node.get("", ()):
+                if instance not in seen:
+                    seen.add(instance)
+                    routes.append((instance, None))
+            node = node.get(line[pos]) if pos < len(line) else None
+            pos += 1
+        if self._regex_taps and (self._prefilter is None or self._prefilter.match(line)):
+            for instance, regex in self._regex_taps:
+                if instance in seen:
                     continue
-                if "\n" in buf:
-                    offset = buf.find("\n")
-                    buf = buf[offset+1:]
-                    for line in buf.splitlines(keepends=True):
-                        if line[-1] == "\n":
-                            await q.put(line[:-1])
-                        else:
-                            textbuf.append(line)
-                    break
-
-            # Send remaining to queue
+                m = regex.match(line)
+                if m:
+                    seen.add(instance)
+                    routes.append((instance, m))
+        return routes
+
+
+_ROUTER = _Router()
+
+
+_POLL_INTERVAL = 0.05
+_NOTIFY_TIMEOUT = 5
+_INOTIFY = None
+_TAIL_WAKEUPS = 0
+
+
+class _FileWaiter(object):
+    """Wait for a file to be written to.  Uses inotify when available, and falls back to polling
+    otherwise.  With inotify we still wake up every _NOTIFY_TIMEOUT seconds, just in case an event
+    gets lost."""
+
+    def __init__(self, filename: str):
+        self._event = asyncio.Event()
+        self._notifier = _INOTIFY
+        self._wd = None
+        if self._notifier is not None:
+            try:
+                self._wd = self._notifier.add_watch(filename, inotify.IN_MODIFY | inotify.IN_ATTRIB, self._on_event)
+            except OSError as e:
+                _logger.warning("Couldn't watch %s, polling instead: %s" % (filename, e))
+
+    def _on_event(self, mask, name):
+        self._event.set()
+
+    async def wait(self):
+        global _TAIL_WAKEUPS
+        if self._wd is None:
+            await asyncio.sleep(_POLL_INTERVAL)
+        else:
+            try:
+                await asyncio.wait_for(self._event.wait(), _NOTIFY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+        _TAIL_WAKEUPS += 1
+
+    def close(self):
+        if self._wd is not None:
+            self._notifier.rm_watch(self._wd, self._on_event)
+            self._wd = None
+
+
+# Never replay more than this many bytes of any one log file on startup.
+MAX_REPLAY = 1 << 20
+
+_CHECKPOINT_FILENAME = os.path.join(os.environ["HOME"], "r99infologpos.db")
+_CHECKPOINT_INTERVAL = 2
+_CHECKPOINTS = None
+
+
+class _Checkpoints(object):
+    """The inode and byte offset, per log file, up to which every tap has finished with the lines.
+    Kept in memory and written out in batches."""
+
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._positions = {}
+        self._dirty = set()
+        with dbm.open(filename, "c") as db:
+            for key in db.keys():
+                inode, offset = str(db[key], "utf8").split()
+                self._positions[str(key, "utf8")] = int(inode), int(offset)
+
+    def get(self, logfile: str):
+        """Return (inode, offset) for a log file, or None if we've never read it"""
+        return self._positions.get(logfile)
+
+    def renamed_from(self, inode: int):
+        """Find a checkpoint for a log file which has since been renamed, given its inode"""
+        for logfile, position in self._positions.items():
+            if position[0] == inode and not os.path.exists(logfile):
+                return position
+        return None
+
+    def update(self, logfile: str, inode: int, offset: int):
+        self._positions[logfile] = inode, offset
+        self._dirty.add(logfile)
+
+    def flush(self):
+        """Write out any changed positions"""
+        if not self._dirty:
+            return
+        with dbm.open(self._filename, "c") as db:
+            for logfile in self._dirty:
+                db[logfile] = "%d %d" % self._positions[logfile]
+        self._dirty.clear()
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(_CHECKPOINT_INTERVAL)
+                _settle()
+                self.flush()
+        except asyncio.CancelledError:
+            _settle()
+            self.flush()
+
+
+# Lines dispatched but not yet handled by every tap they went to, oldest first:
+# (sequence number, filename, inode, offset, taps).
+_UNHANDLED = collections.deque()
+_SEQ = 0
+
+
+def _settle():
+    """Checkpoint the lines which every tap they went to has finished with"""
+    while _UNHANDLED:
+        seq, filename, inode, offset, taps = _UNHANDLED[0]
+        if any(instance.handled < seq and instance in LogTap._ACTIVE for instance in taps):
+            break
+        _UNHANDLED.popleft()
+        _CHECKPOINTS.update(filename, inode, offset)
+
+
+def checkpoint():
+    """Write out log file positions now, e.g. just before exiting."""
+    if _CHECKPOINTS is not None:
+        _settle()
+        _CHECKPOINTS.flush()
+
+
+def _start_offset(filename: str, st: os.stat_result, max_replay: int, new: bool):
+    """Decide where to start reading a log file.  Returns a byte offset, and whether that offset is
+    known to be at the start of a line."""
+    cp = None
+    if _CHECKPOINTS is not None:
+        cp = _CHECKPOINTS.get(filename) or _CHECKPOINTS.renamed_from(st.st_ino)
+    if cp is None:
+        if new:
+            return 0, True
+        return st.st_size, False
+    inode, offset = cp
+    if inode != st.st_ino or offset > st.st_size:
+        # The file was replaced or truncated since we saw it, so all of it is new.
+        offset = 0
+    if max_replay is not None and st.st_size - offset > max_replay:
+        return st.st_size - max_replay, False
+    return offset, True
+
+
+# How log files are decoded.  Lines are split on b"\n" before decoding, which is safe for ASCII
+# supersets like utf-8 and latin-1.
+ENCODING = "utf-8"
+_READ_SIZE = 64 << 10
+_MAX_LINE = 1 << 20
+
+
+async def _tail(filename: str, q: asyncio.Queue, max_replay: int = MAX_REPLAY, new: bool = False,
+                encoding: str = ENCODING):
+    """Watch a file, and pass (filename, inode, offset, line) for all new lines to the specified
+    queue, where offset is the byte offset just past the line.  Resumes from the file's checkpoint
+    if there is one, replaying at most max_replay bytes, and otherwise starts at the end (or at the
+    beginning, for a file which has just appeared)."""
+    waiter = _FileWaiter(filename)
+    buf = bytearray(_READ_SIZE)
+    view = memoryview(buf)
+    try:
+        with open(filename, "rb", buffering=0) as infile:
+            st = os.fstat(infile.fileno())
+            base, aligned = _start_offset(filename, st, max_replay, new)
+            # If we're not at the start of a line, back up a byte and skip to the next newline.
+            skipping = not aligned and base > 0
+            if skipping:
+                base -= 1
+            infile.seek(base, io.SEEK_SET)
+            # buf[:filled] holds file data starting at offset base; buf[start:filled] is the
+            # current incomplete line.
+            filled = 0
+            start = 0
             while True:
-                buf = infile.read(1024)
-                if len(buf) == 0:
-                    await asyncio.sleep(0.05)
+                if filled == len(buf):
+                    if start > 0:
+                        buf[:filled-start] = buf[start:filled]
+                        base += start
+                        filled -= start
+                        start = 0
+                    elif len(buf) < _MAX_LINE:
+                        view.release()
+                        buf.extend(bytes(len(buf)))
+                        view = memoryview(buf)
+                    else:
+                        _logger.warning("Discarding a line over %d bytes long in %s" % (_MAX_LINE, filename))
+                        base += filled
+                        filled = 0
+                        skipping = True
+
+                n = infile.readinto(view[filled:])
+                if not n:
+                    if os.fstat(infile.fileno()).st_size < base + start:
+                        _logger.info("%s was truncated, reading from the start" % filename)
+                        base, filled, start, skipping = 0, 0, 0, False
+                        infile.seek(0, io.SEEK_SET)
+                        continue
+                    await waiter.wait()
                     continue
-                textbuf.append(buf)
-                if "\n" in buf:
-                    buf = "".join(textbuf)
-                    textbuf.clear()
-                    for line in buf.splitlines(keepends=True):
-                        if line[-1] == "\n":
-                            await q.put(line[:-1])
-                        else:
-                            textbuf.append(line)
+
+                end = buf.find(b"\n", filled, filled + n)
+                filled += n
+                while end >= 0:
+                    if skipping:
+                        skipping = False
+                    else:
+                        stop = end
+                        if stop > start and buf[stop-1] == 13:
+                            stop -= 1
+                        line = str(view[start:stop], encoding, "replace")
+                        q.put_nowait((filename, st.st_ino, base + end + 1, line))
+                    start = end + 1
+                    end = buf.find(b"\n", start, filled)
+    except FileNotFoundError:
+        _logger.info("%s went away before we could read it" % filename)
     except asyncio.CancelledError:
         pass
+    finally:
+        view.release()
+        waiter.close()
+
+_LOGFILE_RE = re.compile("eqlog_.*[.]txt$")
+_TIMESTAMP_FORMAT = "%a %b %d %H:%M:%S %Y"
+_last_stamp_text = None
+_last_stamp = None
+
+
+def _parse_timestamp(text: str) -> datetime.datetime:
+    """Parse an EQ log timestamp, e.g. 'Sat Apr 14 08:56:08 2018'.  Runs of lines usually share
+    a timestamp, so the last result is remembered."""
+    global _last_stamp_text, _last_stamp
+    if text != _last_stamp_text:
+        try:
+            _last_stamp = datetime.datetime.strptime(text, _TIMESTAMP_FORMAT)
+        except ValueError:
+            _last_stamp = datetime.datetime.now()
+        _last_stamp_text = text
+    return _last_stamp
 
-_LOGFILE_RE = re.compile("eqlog_.*[.]txt")
-_LOGLINE_RE = re.compile(r"^\[[^\]]*\] (.*)$")
 
+def _parse_line(source: str, line: str) -> LogEvent:
+    """Split a raw log line into a LogEvent, or return None if it isn't a log line"""
+    if not line.startswith("["):
+        return None
+    end = line.find("] ")
+    if end < 0:
+        return None
+    return LogEvent(_parse_timestamp(line[1:end]), source, line[end+2:])
 
-async def _watch_logs(directory: str):
-    """Watch all log files in a directory"""
-    rq = asyncio.Queue()
-    logdir = os.path.join(directory, "Logs")
-    for filename in os.listdir(logdir):
-        if _LOGFILE_RE.match(filename):
-            asyncio.ensure_future(_tail(os.path.join(logdir, filename), rq))
 
+_RESCAN_INTERVAL = 10
+
+
+class _LogDirectory(object):
+    """Keep a _tail task running for each log file in a directory, as files are created, renamed,
+    replaced and deleted.  Follows the directory with inotify if possible, and otherwise rescans
+    it every _RESCAN_INTERVAL seconds."""
+
+    def __init__(self, logdir: str, q: asyncio.Queue, max_replay: int, encoding: str):
+        self._logdir = logdir
+        self._q = q
+        self._max_replay = max_replay
+        self._encoding = encoding
+        self._tails = {}
+
+    def start(self):
+        self.rescan(new=False)
+        if _INOTIFY is not None:
+            try:
+                _INOTIFY.add_watch(self._logdir,
+                                   inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE,
+                                   self._on_event)
+                return
+            except OSError as e:
+                _logger.warning("Couldn't watch %s, rescanning periodically instead: %s" % (self._logdir, e))
+        asyncio.ensure_future(self._poll())
+
+    def _start_tail(self, name: str, new: bool):
+        self._stop_tail(name)
+        filename = os.path.join(self._logdir, name)
+        try:
+            inode = os.stat(filename).st_ino
+        except FileNotFoundError:
+            return
+        _logger.info("Reading %s" % name)
+        task = asyncio.ensure_future(_tail(filename, self._q, self._max_replay, new, self._encoding))
+        self._tails[name] = task, inode
+
+    def _stop_tail(self, name: str):
+        tail = self._tails.pop(name, None)
+        if tail is not None:
+            tail[0].cancel()
+
+    def rescan(self, new: bool = True):
+        """Start and stop tails to match the files present, restarting any whose file has been
+        replaced by another of the same name"""
+        present = {}
+        for name in os.listdir(self._logdir):
+            if _LOGFILE_RE.match(name):
+                try:
+                    present[name] = os.stat(os.path.join(self._logdir, name)).st_ino
+                except FileNotFoundError:
+                    pass
+        for name in set(self._tails) - set(present):
+            self._stop_tail(name)
+        for name, inode in present.items():
+            tail = self._tails.get(name)
+            if tail is None or tail[1] != inode:
+                self._start_tail(name, new)
+
+    def _on_event(self, mask, name):
+        if name is None:
+            self.rescan()
+        elif not _LOGFILE_RE.match(name):
+            return
+        elif mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            self._start_tail(name, True)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self._stop_tail(name)
+
+    async def _poll(self):
+        try:
+            while True:
+                await asyncio.sleep(_RESCAN_INTERVAL)
+                self.rescan()
+        except asyncio.CancelledError:
+            pass
+
+
+_HELD = object()
+_QUEUE = None
+
+
+async def _dispatch(filename: str, inode: int, offset: int, event: LogEvent, block: bool = False):
+    """Hand a line to its taps.  It's checkpointed once they've all finished with it.  With block,
+    wait for room in full taps rather than drop anything."""
+    global _SEQ
+    _SEQ += 1
+    taps = []
+    if event is not None:
+        for instance, match in _ROUTER.route(event.text):
+            await instance.post_event(event, match, _SEQ, block)
+            taps.append(instance)
+    _UNHANDLED.append((_SEQ, filename, inode, offset, taps))
+
+
+async def _watch_logs(directory: str, max_replay: int, encoding: str):
+    """Watch all log files in a directory.  Line listeners see every line as it's read, but taps
+    only get lines once start() is called; until then they're held.  Lines are checkpointed once
+    every tap they went to has finished with them."""
+    _LogDirectory(os.path.join(directory, "Logs"), _QUEUE, max_replay, encoding).start()
+
+    held = []
     try:
         while True:
-            line = await rq.get()
-            m = _LOGLINE_RE.match(line)
-            if m:
-                active = [instance for instance in LogTap._ACTIVE]
-                for instance in active:
-                    await instance.post_line(m.group(1))
+            item = await _QUEUE.get()
+            if item is _HELD:
+                _logger.info("Dispatching %d held lines" % len(held))
+                # There may be far more of these than fit in the taps, so wait for the taps'
+                # consumers to catch up rather than drop any.
+                for filename, inode, offset, event in held:
+                    await _dispatch(filename, inode, offset, event, True)
+                held = None
+                continue
+            filename, inode, offset, line = item
+            event = _parse_line(filename, line)
+            if event is not None:
+                for listener in _LINE_LISTENERS:
+                    try:
+                        listener(event)
+                    except Exception:
+                        _logger.error("Line listener failed", exc_info=True)
+            if held is not None:
+                held.append((filename, inode, offset, event))
+            else:
+                await _dispatch(filename, inode, offset, event)
     except asyncio.CancelledError:
         pass
 
 _is_init = False
 
 
-async def init(directory: str):
-    global _is_init
+async def init(directory: str, max_replay: int = MAX_REPLAY, encoding: str = ENCODING):
+    """Start watching EQ's logs.  Lines written since the last run are replayed, up to max_replay
+    bytes per log file (or without limit if max_replay is None), once start() is called.
+    Undecodable bytes in the logs are replaced."""
+    global _is_init, _INOTIFY, _CHECKPOINTS, _QUEUE
     if _is_init:
         return
     _is_init = True
-    asyncio.ensure_future(_watch_logs(directory))
+    _CHECKPOINTS = _Checkpoints(_CHECKPOINT_FILENAME)
+    asyncio.ensure_future(_CHECKPOINTS.run())
+    try:
+        _INOTIFY = inotify.Inotify()
+    except OSError as e:
+        _logger.warning("inotify unavailable, polling log files instead: %s" % e)
+    _QUEUE = asyncio.Queue()
+    asyncio.ensure_future(_watch_logs(directory, max_replay, encoding))
+
+
+_is_started = False
+
+
+def start():
+    """Start handing lines to taps, beginning with the ones replayed and read since init().  Call
+    this once every module's taps are open, so that none of the replayed lines are missed."""
+    global _is_started
+    if _is_started:
+        return
+    _is_started = True
+    _QUEUE.put_nowait(_HELD)
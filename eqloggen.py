@@ -0,0 +1,127 @@
+# eqloggen.py: Generate synthetic EverQuest log traffic, for benchmarks and testing.
+
+import asyncio
+import bisect
+import itertools
+import random
+import time
+
+_CLASSES = ["Warrior", "Cleric", "Paladin", "Ranger", "Shadow Knight", "Druid", "Monk", "Bard", "Rogue",
+            "Shaman", "Necromancer", "Wizard", "Magician", "Enchanter"]
+_RACES = ["Human", "Barbarian", "Erudite", "Wood Elf", "High Elf", "Dark Elf", "Half Elf", "Dwarf", "Troll",
+          "Ogre", "Halfling", "Gnome", "Iksar"]
+_ZONES = ["ecommons", "nektulos", "lavastorm", "oasis", "innothule", "guktop", "unrest", "mistmoore"]
+_GUILDS = ["", "Guild of Gankers", "Lords of Sky", "Bastion", "Inquisition"]
+_NOISE = ["You are out of food and drink.", "You are out of food.", "You are hungry.",
+          "Your faction standing with Guards of Qeynos got worse.", "You have entered East Commonlands."]
+
+# Relative frequency of each kind of traffic.
+DEFAULT_MIX = {"ooc": 40, "tell": 5, "who": 10, "pvp": 2, "noise": 43}
+
+_TIMESTAMP_FORMAT = "%a %b %d %H:%M:%S %Y"
+
+
+def seq_name(seq: int) -> str:
+    """A player name which encodes a sequence number, e.g. 'Xbd'"""
+    letters = []
+    while True:
+        letters.append(chr(ord("a") + seq % 26))
+        seq //= 26
+        if seq == 0:
+            break
+    return "X" + "".join(letters)
+
+
+def timestamp(when: float = None) -> str:
+    """Format a time as EQ does at the start of each log line"""
+    return "[%s] " % time.strftime(_TIMESTAMP_FORMAT, time.localtime(when))
+
+
+def who_lines(entries, header: bool = True) -> [str]:
+    """Format /who output for a list of (classlevel, name, race, guild, zone)"""
+    lines = []
+    if header:
+        lines.append("Players on EverQuest:")
+        lines.append("---------------------------")
+    for classlevel, name, race, guild, zone in entries:
+        line = "[%s] %s (%s)" % (classlevel, name, race)
+        if guild:
+            line += " <%s>" % guild
+        line += " ZONE: %s" % zone
+        lines.append(line)
+    if len(entries) == 0:
+        lines.append("There are no players in EverQuest that match those who filters.")
+    elif len(entries) == 1:
+        lines.append("There is 1 player in EverQuest.")
+    else:
+        lines.append("There are %d players in EverQuest." % len(entries))
+    return lines
+
+
+class LogGenerator(object):
+    """Produce a mix of OOC, tells, /who output, PvP kills and other noise.  Every OOC message, tell
+    and kill carries a sequence number ('#123') so consumers can report which line they got."""
+
+    def __init__(self, mix: dict = None, seed: int = None):
+        self._random = random.Random(seed)
+        mix = mix if mix is not None else DEFAULT_MIX
+        self._kinds = list(mix.keys())
+        self._cumulative = list(itertools.accumulate(mix[kind] for kind in self._kinds))
+        self.seq = 0
+
+    def random_player(self):
+        r = self._random
+        return ("%d %s" % (r.randint(1, 60), r.choice(_CLASSES)), seq_name(r.randint(0, 5000)).capitalize(),
+                r.choice(_RACES), r.choice(_GUILDS), r.choice(_ZONES))
+
+    def generate(self):
+        """Return (kind, seq, [message text]) for the next piece of traffic.  seq is None for
+        traffic without a sequence number."""
+        r = self._random
+        kind = self._kinds[bisect.bisect(self._cumulative, r.random() * self._cumulative[-1])]
+        if kind == "who":
+            return kind, None, who_lines([self.random_player() for i in range(r.randint(0, 12))])
+        if kind == "noise":
+            return kind, None, [r.choice(_NOISE)]
+        self.seq += 1
+        seq = self.seq
+        if kind == "ooc":
+            text = "%s says out of character, 'WTS stuff #%d'" % (self.random_player()[1], seq)
+        elif kind == "tell":
+            text = "%s tells you, 'hey there #%d'" % (self.random_player()[1], seq)
+        else:
+            loser = self.random_player()
+            winner = self.random_player()
+            text = "[PvP] %s <%s> has been defeated by %s <%s> in Arena #%d!" % (
+                loser[1], loser[3], winner[1], winner[3], seq)
+        return kind, seq, [text]
+
+    async def run(self, filename: str, rate: float, duration: float, on_write=None):
+        """Append traffic to a log file at roughly rate lines per second, for duration seconds.
+        on_write(kind, seq, when) is called for every sequenced line as it's written."""
+        tick = 0.01
+        started = last = time.monotonic()
+        owed = 0.0
+        written = 0
+        with open(filename, "a", newline="\r\n") as outfile:
+            while last - started < duration:
+                now = time.monotonic()
+                owed += rate * (now - last)
+                last = now
+                stamp = timestamp()
+                sequenced = []
+                while owed >= 1:
+                    kind, seq, texts = self.generate()
+                    for text in texts:
+                        outfile.write(stamp + text + "\n")
+                    owed -= len(texts)
+                    written += len(texts)
+                    if seq is not None:
+                        sequenced.append((kind, seq))
+                outfile.flush()
+                if on_write is not None:
+                    now = time.monotonic()
+                    for kind, seq in sequenced:
+                        on_write(kind, seq, now)
+                await asyncio.sleep(tick)
+        return written
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3.5
+
+# eqsim.py: A stand-in for the EverQuest client, for running the bot headless in tests and
+# benchmarks.
+#
+# The simulator owns an EQ directory and writes a log into its Logs folder as the real client
+# does.  It also installs a fake xdotool there, which hands the bot's input to the simulator over
+# a Unix socket.  Typed /who all, /friends and /friend commands are answered in the log after a
+# configurable latency, and background OOC, tells and PvP kills are written at a steady rate.
+#
+# Usage: ./eqsim.py --dir /tmp/eqsim --rate 20
+#        then run the bot with R99_XDOTOOL=/tmp/eqsim/xdotool, and EQ_DIR = "/tmp/eqsim" in conf.py
+
+import argparse
+import asyncio
+import eqloggen
+import json
+import logging
+import os
+import random
+import socket
+import sys
+
+_logger = logging.getLogger("eqsim")
+
+# Background traffic, as eqloggen.DEFAULT_MIX but without /who output: that only ever shows up
+# in the log when the bot asks for it.
+DEFAULT_MIX = {"ooc": 40, "tell": 5, "pvp": 2, "noise": 53}
+
+_WINDOW = 4242
+_OTHER_WINDOW = 17
+_POSITION = (0, 0)
+_SIZE = (1024, 768)
+_WHO_LIMIT = 20
+
+
+class Simulator(object):
+    """A pretend EQ client and world.  players is how many characters are online to begin with;
+    every churn seconds one of them camps and somebody else logs in."""
+
+    def __init__(self, eqdir: str, character: str = "Simbot", latency: float = 0.2, rate: float = 20,
+                 players: int = 200, churn: float = 1, mix: dict = None, seed: int = None):
+        self.eqdir = os.path.abspath(eqdir)
+        self.logfile = os.path.join(self.eqdir, "Logs", "eqlog_%s_P1999PVP.txt" % character)
+        self.socket = os.path.join(self.eqdir, "eqsim.sock")
+        self.xdotool = os.path.join(self.eqdir, "xdotool")
+        self.latency = latency
+        self.rate = rate
+        self.churn = churn
+        self.friends = set()
+        self.players = {}
+        self.commands = 0
+        self._random = random.Random(seed)
+        self._generator = eqloggen.LogGenerator(mix if mix is not None else DEFAULT_MIX, seed)
+        for i in range(players):
+            self.login()
+        self._focused = False
+        self._input = None
+        self._outfile = None
+        self._server = None
+        self._tasks = []
+
+    async def start(self):
+        """Create the EQ directory and fake xdotool, and start answering"""
+        os.makedirs(os.path.dirname(self.logfile), exist_ok=True)
+        self._outfile = open(self.logfile, "a", newline="\r\n")
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        self._server = await asyncio.start_unix_server(self._on_client, self.socket)
+        with open(self.xdotool, "w") as outfile:
+            outfile.write('#!/bin/sh\nexec "%s" "%s" --xdotool "%s" "$@"\n' % (
+                sys.executable, os.path.abspath(__file__), self.socket))
+        os.chmod(self.xdotool, 0o755)
+        self._tasks.append(asyncio.ensure_future(self._background()))
+        if self.churn > 0:
+            self._tasks.append(asyncio.ensure_future(self._churn()))
+        _logger.info("Simulating EQ in %s" % self.eqdir)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+        self._outfile.close()
+
+    def login(self, name: str = None):
+        """Bring a character online, somewhere random"""
+        player = self._generator.random_player()
+        if name is not None:
+            player = (player[0], name.capitalize()) + player[2:]
+        self.players[player[1].lower()] = player
+
+    def logout(self, name: str):
+        self.players.pop(name.lower(), None)
+
+    def write(self, lines: [str]):
+        """Append lines to the log, as EQ would"""
+        stamp = eqloggen.timestamp()
+        for line in lines:
+            self._outfile.write(stamp + line + "\n")
+        self._outfile.flush()
+
+    async def _background(self):
+        tick = 0.05
+        owed = 0.0
+        while True:
+            await asyncio.sleep(tick)
+            owed += self.rate * tick
+            lines = []
+            while owed >= 1:
+                texts = self._generator.generate()[2]
+                lines.extend(texts)
+                owed -= len(texts)
+            if lines:
+                self.write(lines)
+
+    async def _churn(self):
+        while True:
+            await asyncio.sleep(self.churn)
+            if self.players:
+                self.logout(self._random.choice(list(self.players)))
+            self.login()
+
+    async def _on_client(self, reader, writer):
+        try:
+            args = json.loads(str(await reader.readline(), "utf8"))
+            status, output = await self._xdo(args)
+            writer.write(bytes("%d\n" % status + "".join(line + "\n" for line in output), "utf8"))
+            await writer.drain()
+        except Exception:
+            _logger.error("Bad xdotool request", exc_info=True)
+        finally:
+            writer.close()
+
+    async def _xdo(self, args: [str]):
+        """Carry out a chain of xdotool commands.  Returns the exit status and output."""
+        output = []
+        i = 0
+        while i < len(args):
+            command = args[i]
+            i += 1
+            if command == "search":
+                while i < len(args) and args[i].startswith("--"):
+                    i += 1
+                i += 1
+                output.append(str(_WINDOW))
+            elif command == "getactivewindow":
+                output.append(str(_WINDOW if self._focused else _OTHER_WINDOW))
+            elif command == "getwindowgeometry":
+                if i < len(args) and args[i].isdigit():
+                    i += 1
+                output.append("Window %d" % _WINDOW)
+                output.append("  Position: %d,%d (screen: 0)" % _POSITION)
+                output.append("  Geometry: %dx%d" % _SIZE)
+            elif command == "mousemove":
+                i += 2
+            elif command in ("click", "windowmap", "windowraise"):
+                i += 1
+            elif command in ("windowfocus", "windowactivate"):
+                i += 1
+                self._focused = True
+            elif command == "sleep":
+                await asyncio.sleep(float(args[i]))
+                i += 1
+            elif command == "key":
+                self._key(args[i])
+                i += 1
+            elif command == "type":
+                delay = 12
+                if i < len(args) and args[i] == "--delay":
+                    delay = float(args[i+1])
+                    i += 2
+                text = " ".join(args[i:])
+                i = len(args)
+                await asyncio.sleep(len(text) * delay / 1000)
+                if self._focused and self._input is not None:
+                    self._input += text
+            else:
+                return 1, ["Unknown command: %s" % command]
+        return 0, output
+
+    def _key(self, key: str):
+        if not self._focused:
+            return
+        if key == "Return":
+            if self._input is None:
+                self._input = ""
+            else:
+                text, self._input = self._input, None
+                if text:
+                    self.commands += 1
+                    latency = self.latency * (0.5 + self._random.random())
+                    asyncio.get_event_loop().call_later(latency, self._answer, text)
+        elif key == "Escape":
+            self._input = None
+
+    def _answer(self, text: str):
+        parts = text.split()
+        command = parts[0].lower()
+        if command == "/who" and len(parts) > 1 and parts[1].lower() == "all":
+            self.write(self._who(parts[2:]))
+        elif command == "/friends" and len(parts) == 1:
+            lines = ["List of Friends", "-----------------"]
+            lines.extend(name.capitalize() for name in sorted(self.friends))
+            if self.friends:
+                lines.append("You have %d friend(s)." % len(self.friends))
+            else:
+                lines.append("You have no friends! Awww, how sad...")
+            self.write(lines)
+        elif command in ("/friend", "/friends") and len(parts) == 2:
+            name = parts[1].lower()
+            if name in self.friends:
+                self.friends.remove(name)
+                self.write(["%s is no longer your friend." % parts[1]])
+            else:
+                self.friends.add(name)
+                self.write(["%s is now your friend." % parts[1]])
+        elif not command.startswith("/"):
+            self.write(["You say, '%s'" % text])
+        else:
+            self.write(["That is not a valid command.  Please use /help."])
+
+    def _who(self, terms: [str]) -> [str]:
+        terms = [term.lower() for term in terms]
+        players = self.players.values()
+        if "friends" in terms:
+            terms.remove("friends")
+            if not self.friends:
+                return ["You have no friends, but you can add some with: /friends <name>"]
+            players = [p for p in players if p[1].lower() in self.friends]
+        entries = sorted((p for p in players if all(self._who_matches(p, term) for term in terms)),
+                         key=lambda p: p[1])
+        if len(entries) > _WHO_LIMIT:
+            return eqloggen.who_lines(entries[:_WHO_LIMIT])[:-1] + \
+                ["Your who request was cut short..too many players."]
+        return eqloggen.who_lines(entries)
+
+    @staticmethod
+    def _who_matches(player, term: str) -> bool:
+        classlevel, name, race, guild, zone = player
+        return term in name.lower() or term == zone or term in guild.lower() or term in classlevel.lower()
+
+
+def _xdotool_main(socket_path: str, args: [str]):
+    """The fake xdotool: pass the arguments to the simulator, and print what it says"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except OSError as e:
+        sys.stderr.write("Can't reach the EQ simulator: %s\n" % e)
+        return 1
+    s.sendall(bytes(json.dumps(args) + "\n", "utf8"))
+    response = b""
+    while True:
+        data = s.recv(65536)
+        if not data:
+            break
+        response += data
+    s.close()
+    status, _, output = str(response, "utf8").partition("\n")
+    sys.stdout.write(output)
+    return int(status) if status else 1
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Simulate an EverQuest client for the bot")
+    parser.add_argument("--dir", required=True, help="EQ directory to create (point conf.EQ_DIR here)")
+    parser.add_argument("--character", default="Simbot", help="name of the logged in character")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean seconds before a command is answered")
+    parser.add_argument("--rate", type=float, default=20, help="background log lines per second")
+    parser.add_argument("--players", type=int, default=200, help="characters online")
+    parser.add_argument("--churn", type=float, default=1, help="seconds between logins/camps (0 for none)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    args = parser.parse_args()
+    sim = Simulator(args.dir, args.character, args.latency, args.rate, args.players, args.churn, seed=args.seed)
+    await sim.start()
+    print("Run the bot with R99_XDOTOOL=%s and EQ_DIR = %r" % (sim.xdotool, sim.eqdir))
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == "--xdotool":
+        sys.exit(_xdotool_main(sys.argv[2], sys.argv[3:]))
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s | %(name)s | %(msg)s")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -5,24 +5,79 @@ import chat
 import eqcmd
 import re
 import misc
-import dbm
 import discord
 import os
 import os.path
 import pickle
 import logging
 import spam
+import state
 import who
 import time
 import datetime
-import shelve
 
 _LOG = logging.getLogger("friends")
-_WATCHES = dbm.open(os.path.join(os.environ["HOME"], "r99infowatches.db"), "c")
-_ONLINE_STATES = shelve.open(os.path.join(os.environ["HOME"], "r99infoonline.db"), "c", 2)
+# Player name -> frozenset of the ids of the users watching them.
+_WATCHES = state.table("watches", lambda: state.dbm_items(os.path.join(os.environ["HOME"], "r99infowatches.db"),
+                                                          pickle.loads))
 _SYNCED = False
 
-_WATCH_MAX = 100
+_USER_WATCH_MAX = 20
+
+# EQ's friends list holds this many names.  The most watched players go on it; the rest are
+# covered by /who all sweeps.
+_FRIEND_CAP = 100
+_FRIEND_TIER = set()
+
+# In-memory indexes of the watches: player name -> set of user ids, and user id -> set of names.
+_WATCHERS = {}
+_WATCHED_BY = {}
+
+
+def _load_watches():
+    for name, watchers in list(_WATCHES.items()):
+        # Older databases hold whole discord.Member objects.
+        ids = frozenset(getattr(user, "id", user) for user in watchers)
+        _WATCHES[name] = ids
+        _WATCHERS[name] = set(ids)
+        for user_id in ids:
+            _WATCHED_BY.setdefault(user_id, set()).add(name)
+
+
+_load_watches()
+
+
+def _add_watch(name: str, user_id: str):
+    _WATCHERS.setdefault(name, set()).add(user_id)
+    _WATCHED_BY.setdefault(user_id, set()).add(name)
+    _WATCHES[name] = frozenset(_WATCHERS[name])
+
+
+def _remove_watch(name: str, user_id: str):
+    watchers = _WATCHERS.get(name, set())
+    watchers.discard(user_id)
+    names = _WATCHED_BY.get(user_id, set())
+    names.discard(name)
+    if not names:
+        _WATCHED_BY.pop(user_id, None)
+    if watchers:
+        _WATCHES[name] = frozenset(watchers)
+    else:
+        _WATCHERS.pop(name, None)
+        _SWEEPS.pop(name, None)
+        if name in _SWEEP_STATE:
+            del _SWEEP_STATE[name]
+        if name in _WATCHES:
+            del _WATCHES[name]
+        if name in _ONLINE_STATES:
+            del _ONLINE_STATES[name]
+
+
+def _user_name(user_id: str) -> str:
+    user = chat.get_user(user_id)
+    if user is None:
+        return "<@%s>" % user_id
+    return "%s#%s" % (user.name, user.discriminator)
 
 _NAME_RE = re.compile("[a-zA-Z]+")
 
@@ -41,24 +96,24 @@ async def _watch_cmd(msg):
         return
 
     name = name.lower()
-    if name in _WATCHES:
-        watchers = pickle.loads(_WATCHES[name])
-    else:
-        if len([k for k in _WATCHES.keys()]) >= _WATCH_MAX:
-            chat.fade(await chat.send_error(msg.channel, "`watch`",
-                                            "%s, too many watches.  Get rid of some (try !listwatch)" %
-                                            msg.author.mention))
-            return
-        watchers = set([])
-        _SYNCED = False
-
-    if msg.author in watchers:
+    if msg.author.id in _WATCHERS.get(name, ()):
         chat.fade(await chat.send_error(msg.channel, "`watch`",
                                         "%s, You're already watching `%s`" % (msg.author.mention, name)))
         return
+    if len(_WATCHED_BY.get(msg.author.id, ())) >= _USER_WATCH_MAX:
+        chat.fade(await chat.send_error(msg.channel, "`watch`",
+                                        "%s, you're watching %d players already.  Get rid of some (try !listwatch mine)" %
+                                        (msg.author.mention, _USER_WATCH_MAX)))
+        return
+    if name not in _WATCHERS and len(_WATCHERS) >= _WATCH_MAX:
+        chat.fade(await chat.send_error(msg.channel, "`watch`",
+                                        "%s, too many watches (%d max).  Get rid of some (try !listwatch)" %
+                                        (msg.author.mention, _WATCH_MAX)))
+        return
 
-    watchers.add(msg.author)
-    _WATCHES[name] = pickle.dumps(watchers)
+    _add_watch(name, msg.author.id)
+    # Even for a player who's already watched, the extra watcher may move them onto the friends list.
+    _SYNCED = False
     chat.fade(await chat.send_info(msg.channel, "`watch`", "%s, watch added for `%s`" % (msg.author.mention, name)))
 
 
@@ -76,22 +131,13 @@ async def _unwatch_cmd(msg):
         return
 
     name = name.lower()
-    if name in _WATCHES:
-        watchers = pickle.loads(_WATCHES[name])
-    else:
-        watchers = set([])
-
-    if msg.author not in watchers:
+    if msg.author.id not in _WATCHERS.get(name, ()):
         chat.fade(await chat.send_error(msg.channel,
                                         "`unwatch`", "%s, You're not watching `%s`" % (msg.author.mention, name)))
         return
 
-    watchers.remove(msg.author)
-    if len(watchers) != 0:
-        _WATCHES[name] = pickle.dumps(watchers)
-    else:
-        del _WATCHES[name]
-        _SYNCED = False
+    _remove_watch(name, msg.author.id)
+    _SYNCED = False
     chat.fade(await chat.send_info(msg.channel, "`unwatch`", "%s, watch removed for `%s`" % (msg.author.mention, name)))
 
 
@@ -114,9 +160,10 @@ async def _unfriend_cmd(msg):
         return
 
     name = name.lower()
-    if name in _WATCHES:
+    if name in _WATCHERS:
         _SYNCED = False
-        del _WATCHES[name]
+        for user_id in list(_WATCHERS[name]):
+            _remove_watch(name, user_id)
         chat.fade(await chat.send_info(msg.channel,
                                        "`unwatch`", "%s, all watches removed for `%s`" % (msg.author.mention, name)))
     else:
@@ -125,17 +172,22 @@ async def _unfriend_cmd(msg):
 
 @chat.command("!listwatch", who.CHAR_CATEGORY)
 async def _list_watch_cmd(msg):
-    """List all players currently being watched"""
-    names = [str(k, "utf8") for k in _WATCHES.keys()]
-    names.sort()
+    """List all players currently being watched (or just yours, with `!listwatch mine`)"""
+    parts = msg.content.strip().split()
     watch_text = []
-    for name in names:
-        watchers = pickle.loads(_WATCHES[name])
-        watchers = ["%s#%s" % (user.name, user.discriminator) for user in watchers]
-        watchers.sort()
-        watch_text.append("`%s` by %s" % (name, ", ".join(watchers)))
-    watch_text.append("")
-    watch_text.append("*%d characters watched (%d max)*" % (len(names), _WATCH_MAX))
+    if len(parts) > 1 and parts[1].lower() == "mine":
+        names = sorted(_WATCHED_BY.get(msg.author.id, ()))
+        watch_text.append(", ".join("`%s`" % name for name in names))
+        watch_text.append("")
+        watch_text.append("*%s is watching %d characters (%d max)*" % (msg.author.mention, len(names), _USER_WATCH_MAX))
+    else:
+        names = sorted(_WATCHERS)
+        for name in names:
+            watchers = [_user_name(user_id) for user_id in _WATCHERS[name]]
+            watchers.sort()
+            watch_text.append("`%s` by %s" % (name, ", ".join(watchers)))
+        watch_text.append("")
+        watch_text.append("*%d characters watched (%d max)*" % (len(names), _WATCH_MAX))
     for i in range(0, len(watch_text), 20):
         ul = min(len(watch_text), i+20)
         chat.fade(await chat.send_info(msg.channel, "Current watches", "\n".join(watch_text[i:ul])))
@@ -143,19 +195,9 @@ async def _list_watch_cmd(msg):
 
 async def init():
     """Initialize the friends module."""
+    state.init()
     asyncio.ensure_future(_friends_loop())
-    asyncio.ensure_future(_sync_db())
-
-
-async def _sync_db():
-    """Periodically sync the database."""
-    global _WATCHES, _ONLINE_STATES
-    while True:
-        _WATCHES.close()
-        _WATCHES = dbm.open(os.path.join(os.environ["HOME"], "r99infowatches.db"), "c")
-        _ONLINE_STATES.close()
-        _ONLINE_STATES = shelve.open(os.path.join(os.environ["HOME"], "r99infoonline.db"), "c", 2)
-        await asyncio.sleep(5)
+    asyncio.ensure_future(_sweep_loop())
 
 
 class _OnlineState(object):
@@ -170,9 +212,24 @@ class _OnlineState(object):
     def with_zone(self, zone):
         return _OnlineState(self.first_time, datetime.datetime.now(), zone)
 
+    def __eq__(self, other):
+        # zone_time moves on with every sighting; that alone isn't worth writing to disk.
+        return isinstance(other, _OnlineState) and \
+            self.first_time == other.first_time and \
+            self.zone == other.zone
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.first_time, self.zone))
+
+
+# Player name -> _OnlineState, for the watched players currently online.
+_ONLINE_STATES = state.table("online", lambda: state.shelve_items(os.path.join(os.environ["HOME"], "r99infoonline.db")))
+
 
 async def _friends_loop():
-    global _ONLINE_STATES
     global _SYNCED
     while True:
         await asyncio.sleep(3)
@@ -182,32 +239,30 @@ async def _friends_loop():
             o_friends = await _online_friends()
             if o_friends is None:
                 raise eqcmd.CommandError("Failed to /who friends")
-            players = set(_ONLINE_STATES.keys()).union(o_friends.keys())
+            players = _FRIEND_TIER.intersection(_ONLINE_STATES.keys()).union(o_friends.keys())
             for player in players:
-                old_state = None
-                if player in _ONLINE_STATES:
-                    old_state = _ONLINE_STATES[player]
-                new_entry = None
-                if player in o_friends:
-                    new_entry = o_friends[player]
-                new_state = _state_delta(player, old_state, new_entry)
-                if new_state is None:
-                    if player in _ONLINE_STATES:
-                        del _ONLINE_STATES[player]
-                else:
-                    _ONLINE_STATES[player] = new_state
+                _update_state(player, o_friends.get(player))
 
         except eqcmd.CommandError as e:
             _LOG.error(str(e))
             await asyncio.sleep(5)
 
 
+def _update_state(player: str, new_entry: who.WhoEntry):
+    """Record whether a player is online, and announce any change"""
+    new_state = _state_delta(player, _ONLINE_STATES.get(player), new_entry)
+    if new_state is None:
+        if player in _ONLINE_STATES:
+            del _ONLINE_STATES[player]
+    else:
+        _ONLINE_STATES[player] = new_state
+
+
 def _state_delta(player: str, old_state: _OnlineState, new_entry: who.WhoEntry) -> _OnlineState:
     mentions = []
 
-    if player in _WATCHES:
-        for user in pickle.loads(_WATCHES[player]):
-            mentions.append(user.mention)
+    for user_id in _WATCHERS.get(player, ()):
+        mentions.append("<@%s>" % user_id)
 
     new_state = old_state
     label, outmsg = None, None
@@ -242,14 +297,17 @@ def _state_delta(player: str, old_state: _OnlineState, new_entry: who.WhoEntry)
     if outmsg:
         fmtmsg = "\\[%s\\] **%s** `%s` %s \\[%s\\]" % (
             time.strftime("%l:%M %p").strip(), label, misc.inicap(player), outmsg, " ".join(mentions))
-        asyncio.ensure_future(spam.send(fmtmsg))
+        spam.queue(fmtmsg)
     return new_state
 
 
 async def _sync_friends():
     """Get the actual set of friends to match the expected set of friends"""
-    global _SYNCED, _WATCHES
-    expected = set([str(k, "utf8").lower() for k in _WATCHES.keys()])
+    global _SYNCED, _FRIEND_TIER
+    # Most watched first; ties go alphabetically, so that the list doesn't churn.
+    ranked = sorted(_WATCHERS, key=lambda name: (-len(_WATCHERS[name]), name))
+    _FRIEND_TIER = set(ranked[:_FRIEND_CAP])
+    expected = _FRIEND_TIER
     while True:
         actual = await _friends()
         if actual is None:
@@ -257,10 +315,12 @@ async def _sync_friends():
         if actual == expected:
             _SYNCED = True
             return
-        for person in expected.symmetric_difference(actual):
-            if person in _ONLINE_STATES:
+        toggles = sorted(expected.symmetric_difference(actual))
+        for person in toggles:
+            if person in _ONLINE_STATES and person not in _WATCHERS:
                 del _ONLINE_STATES[person]
-            await _toggle_friend(person)
+        for i in range(0, len(toggles), _TOGGLE_BATCH):
+            await _toggle_friends(toggles[i:i+_TOGGLE_BATCH])
 
 
 _END_FRIENDS = re.compile("You have no friends! Awww, how sad...|You have [0-9]+ friend\(s\)[.]")
@@ -268,51 +328,245 @@ _END_FRIENDS = re.compile("You have no friends! Awww, how sad...|You have [0-9]+
 
 async def _friends():
     """Query for our current set of friends."""
-    with await eqcmd.tap() as et:
-        return await _friends_body(et)
-
-
-@misc.timeout(5)
-async def _friends_body(et: eqcmd.CommandTap):
-    friends = set()
-    await et.send("/friends")
-    await et.skip_until("List of Friends")
-    await et.skip_until("-----------------")
-    while True:
-        line = await et.next_line()
-        if _END_FRIENDS.match(line) is not None:
-            break
-        friends.add(line.lower())
-    return friends
-
-
-_NOW_FRIEND = re.compile(r"([a-z]+) is now your friend.")
-_NOT_FRIEND = re.compile(r"([a-z]+) is no longer your friend.")
-
-
-async def _toggle_friend(name: str) -> bool:
-    """Toggle a player's status as a friend."""
-    with await eqcmd.tap() as et:
-        return await _toggle_friend_body(et, name)
-
-
-@misc.timeout(5)
-async def _toggle_friend_body(et: eqcmd.CommandTap, name: str) -> bool:
-    await et.send("/friend " + name)
-    while True:
-        line = await et.next_line()
-        if _NOW_FRIEND.match(line):
-            return True
-        elif _NOT_FRIEND.match(line):
-            return False
+    result = await eqcmd.transact(eqcmd.Transaction("friends", "/friends",
+                                                    start=["List of Friends", "-----------------"],
+                                                    end=[_END_FRIENDS], collect=str.lower,
+                                                    priority=eqcmd.BACKGROUND, max_wait=30))
+    if result is None:
+        return None
+    return set(result.items)
+
+
+_NOW_FRIEND = re.compile(r"([A-Za-z]+) is now your friend.")
+_NOT_FRIEND = re.compile(r"([A-Za-z]+) is no longer your friend.")
+
+
+# How many /friend commands to type while holding EQ, and how long to wait for the last answer.
+_TOGGLE_BATCH = 25
+_TOGGLE_TIMEOUT = 5
+
+
+async def _toggle_friends(names: [str]) -> dict:
+    """Toggle several players' status as friends, typing all the /friend commands in one go and
+    matching up the answers by name afterwards.  Returns {name: True if now a friend, False if
+    not} for each name EQ answered for."""
+    pending = set(names)
+    toggled = {}
+    with await eqcmd.tap(eqcmd.MAINTENANCE, name="friend", patterns=[_NOW_FRIEND, _NOT_FRIEND]) as ct:
+        started = time.monotonic()
+        await ct.send_all(["/friend " + name for name in names])
+        deadline = time.monotonic() + _TOGGLE_TIMEOUT
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                line = await asyncio.wait_for(ct.next_line(), remaining)
+            except asyncio.TimeoutError:
+                break
+            m = _NOW_FRIEND.match(line) or _NOT_FRIEND.match(line)
+            name = m.group(1).lower()
+            if name in pending:
+                pending.remove(name)
+                toggled[name] = m.re is _NOW_FRIEND
+        eqcmd.count_transaction("friend", None if pending else time.monotonic() - started)
+        if toggled and not pending:
+            # Every name came back, so they were all typed correctly.
+            ct.confirmed()
+    if pending:
+        _LOG.warning("No answer to /friend for %s" % ", ".join(sorted(pending)))
+    return toggled
 
 
 async def _online_friends():
-    wf = await who.who_all("friends")
+    wf = await who.who_all("friends", eqcmd.BACKGROUND, 10, max_age=0)
     if wf is None:
         return None
     online = {}
     for we in wf[0]:
-        if we.name in _WATCHES:
+        if we.name in _FRIEND_TIER:
             online[we.name] = we
     return online
+
+
+# How often, in seconds, a watched player who isn't on the friends list should be looked for:
+# while they're online (to notice them camping), if they've been seen in the last day, in the
+# last week, and otherwise.  Players with more watchers are looked for more often, up to 4 times
+# as often.
+_SWEEP_ONLINE = 60
+_SWEEP_RECENT = 300
+_SWEEP_IDLE = 1800
+_SWEEP_DORMANT = 6 * 3600
+_RECENT = 24 * 3600
+_IDLE = 7 * 24 * 3600
+_WATCHER_BOOST = 4
+_TIER_INTERVALS = {"online": _SWEEP_ONLINE, "recent": _SWEEP_RECENT, "idle": _SWEEP_IDLE, "dormant": _SWEEP_DORMANT}
+
+# At most one sweep every this many seconds, so sweeps can't crowd out everything else in EQ.
+_SWEEP_GAP = 2
+# Look for players by guild once this many of a guild's players are due.
+_GUILD_BATCH = 3
+
+# A sweep takes about this long, gap included.  Watches are capped so that sweeps can keep up
+# with a mix of players like _PLANNED_MIX outside the friends list: when lots of names are
+# watched, most are alts and old characters which are hardly ever on.  With a busier mix, every
+# tier falls behind in proportion (see presence_stats).  Watches beyond the cap are refused.
+_SWEEP_PERIOD = _SWEEP_GAP + 1
+_PLANNED_MIX = {"online": 0.01, "recent": 0.02, "idle": 0.07, "dormant": 0.90}
+_WATCH_MAX = _FRIEND_CAP + int(1 / _SWEEP_PERIOD /
+                               sum(share / _TIER_INTERVALS[tier] for tier, share in _PLANNED_MIX.items()))
+
+
+class _Sweep(object):
+    """When a player outside the friends list was last looked for and last seen (wall clock time,
+    so that it means something after a relog), the guild they were last seen in, and whether
+    looking for them by name can't tell if they're on"""
+    __slots__ = ['checked', 'seen', 'guild', 'unresolved']
+
+    def __init__(self, checked: float = 0.0, seen: float = None, guild: str = None, unresolved: bool = False):
+        self.checked = checked
+        self.seen = seen
+        self.guild = guild
+        self.unresolved = unresolved
+
+
+# Player name -> (checked, seen, guild, unresolved), as in _Sweep.
+_SWEEP_STATE = state.table("sweeps")
+_SWEEPS = {}
+for _name, _values in list(_SWEEP_STATE.items()):
+    if _name in _WATCHERS:
+        _SWEEPS[_name] = _Sweep(*_values)
+    else:
+        del _SWEEP_STATE[_name]
+
+
+def _save_sweep(name: str, sweep: _Sweep):
+    _SWEEP_STATE[name] = sweep.checked, sweep.seen, sweep.guild, sweep.unresolved
+
+
+def _sweep_tier(name: str, sweep: _Sweep, now: float) -> str:
+    if sweep.unresolved:
+        # There's no point looking for them any more often than this.
+        return "dormant"
+    if name in _ONLINE_STATES:
+        return "online"
+    if sweep.seen is not None and now - sweep.seen < _RECENT:
+        return "recent"
+    if sweep.seen is not None and now - sweep.seen < _IDLE:
+        return "idle"
+    return "dormant"
+
+
+def _lateness(name: str, sweep: _Sweep, now: float) -> float:
+    """How far through its interval a player's next sweep is; 1 or more means it's due"""
+    interval = _TIER_INTERVALS[_sweep_tier(name, sweep, now)] / min(len(_WATCHERS.get(name, ())), _WATCHER_BOOST)
+    return (now - sweep.checked) / interval
+
+
+def _next_sweep():
+    """Choose what to look for next: (/who all filter, names it covers), or None if nothing's due"""
+    now = time.time()
+    due = []
+    for name in _WATCHERS:
+        if name in _FRIEND_TIER:
+            continue
+        sweep = _SWEEPS.get(name)
+        if sweep is None:
+            sweep = _SWEEPS[name] = _Sweep()
+        lateness = _lateness(name, sweep, now)
+        if lateness >= 1:
+            due.append((lateness, name))
+    if not due:
+        return None
+    due.sort(reverse=True)
+    first = _SWEEPS[due[0][1]]
+    if first.guild is not None:
+        names = [name for lateness, name in due if _SWEEPS[name].guild == first.guild]
+        # Searching by name doesn't work for some players, so their guild is the only way.
+        if len(names) >= _GUILD_BATCH or first.unresolved:
+            return first.guild, names
+    return due[0][1], [due[0][1]]
+
+
+def _apply_sweep(text: str, names: [str], entries: [who.WhoEntry], count: str):
+    now = time.time()
+    seen = {}
+    for we in entries:
+        if we.name in _WATCHERS and we.name not in _FRIEND_TIER:
+            seen[we.name] = we
+    # A guild search only proves who's offline if it worked, and wasn't cut short.
+    conclusive = count != "more than 20" and (names == [text] or any(we.guild == text for we in entries))
+    for name, we in seen.items():
+        sweep = _SWEEPS.setdefault(name, _Sweep())
+        sweep.checked = sweep.seen = now
+        sweep.guild = we.guild
+        sweep.unresolved = False
+        _save_sweep(name, sweep)
+        _update_state(name, we)
+    for name in names:
+        sweep = _SWEEPS.get(name)
+        if name in seen or sweep is None:
+            continue
+        if conclusive:
+            sweep.checked = now
+            sweep.unresolved = False
+            _save_sweep(name, sweep)
+            _update_state(name, None)
+        elif names == [text]:
+            # Too many players match the name itself (e.g. "troll") to tell whether they're on.
+            # Don't ask again until it's due at the dormant rate; a guild search may work once
+            # they've been seen in one.
+            sweep.checked = now
+            if not sweep.unresolved:
+                _LOG.info("Can't find out whether %s is online by searching for their name" % name)
+            sweep.unresolved = True
+            _save_sweep(name, sweep)
+        else:
+            # Look for them by name instead.
+            sweep.guild = None
+            _save_sweep(name, sweep)
+
+
+async def _sweep_loop():
+    """Look for watched players who don't fit on the friends list, a /who all at a time, when EQ
+    has nothing more important to do"""
+    while True:
+        await asyncio.sleep(_SWEEP_GAP)
+        if not _SYNCED or not eqcmd.is_ready():
+            continue
+        query = _next_sweep()
+        if query is None:
+            continue
+        text, names = query
+        try:
+            result = await who.who_all(text, eqcmd.MAINTENANCE, _SWEEP_GAP * 5, max_age=0)
+        except eqcmd.CommandError:
+            continue
+        except eqcmd.NotReadyError:
+            await asyncio.sleep(_SWEEP_GAP * 5)
+            continue
+        if result is not None:
+            _apply_sweep(text, names, result[0], result[1])
+
+
+def presence_stats() -> [dict]:
+    """Per tier of watched players: how many there are, how many are overdue to be looked for,
+    the most overdue, as a multiple of the tier's interval, and how many can't be looked for by
+    name"""
+    now = time.time()
+    stats = {"friends": {"tier": "friends", "names": len(_FRIEND_TIER), "overdue": 0, "max_lateness": 0.0,
+                         "unresolved": 0}}
+    for tier in ("online", "recent", "idle", "dormant"):
+        stats[tier] = {"tier": tier, "names": 0, "overdue": 0, "max_lateness": 0.0, "unresolved": 0}
+    for name, sweep in _SWEEPS.items():
+        if name in _FRIEND_TIER:
+            continue
+        tier = stats[_sweep_tier(name, sweep, now)]
+        lateness = _lateness(name, sweep, now)
+        tier["names"] += 1
+        if sweep.unresolved:
+            tier["unresolved"] += 1
+        if lateness >= 1:
+            tier["overdue"] += 1
+        tier["max_lateness"] = max(tier["max_lateness"], lateness)
+    return [stats[tier] for tier in ("friends", "online", "recent", "idle", "dormant")]
@@ -0,0 +1,119 @@
+# inotify.py: Minimal asyncio binding to Linux inotify, via ctypes.
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c")
+        if name is None:
+            raise OSError(errno.ENOSYS, "Couldn't find libc")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported on this platform")
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+class Inotify(object):
+    """An inotify instance whose events are delivered to callbacks from the asyncio event loop.
+    Raises OSError from the constructor if inotify isn't available."""
+
+    def __init__(self, loop=None):
+        self._libc = _load_libc()
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._callbacks = {}
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def add_watch(self, path: str, mask: int, callback) -> int:
+        """Watch a path.  callback(mask, name) is called for each event; name is only set for
+        events on files within a watched directory.  Watching the same file twice gives the same
+        watch descriptor, with both callbacks attached."""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self._callbacks.setdefault(wd, []).append(callback)
+        return wd
+
+    def rm_watch(self, wd: int, callback):
+        """Detach a callback, and stop watching once no callbacks remain"""
+        callbacks = self._callbacks.get(wd)
+        if callbacks is None or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._callbacks[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def close(self):
+        if self._fd >= 0:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+            self._callbacks.clear()
+
+    def _on_readable(self):
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = None
+            if namelen:
+                name = os.fsdecode(buf[offset:offset+namelen].rstrip(b"\0"))
+                offset += namelen
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so tell everybody something may have happened.
+                for callbacks in list(self._callbacks.values()):
+                    for callback in list(callbacks):
+                        callback(mask, None)
+                continue
+            for callback in list(self._callbacks.get(wd, ())):
+                callback(mask, name)
+            if mask & IN_IGNORED:
+                self._callbacks.pop(wd, None)
+
+
+def available() -> bool:
+    """Determine whether inotify can be used here"""
+    try:
+        _load_libc()
+        return True
+    except OSError:
+        return False
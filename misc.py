@@ -34,3 +34,60 @@ def inicap(text):
     if len(text) == 0:
         return ""
     return text.upper()[0]+text.lower()[1:]
+
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+
+class TapQueue(object):
+    """A queue feeding a tap.  If maxsize is positive, the queue is bounded, and the policy decides
+    what happens when the consumer falls behind: BLOCK makes the producer wait, DROP_OLDEST discards
+    the oldest queued item, and DROP_NEWEST discards the item being added.  Keeps counters so that
+    a stuck consumer can be found."""
+
+    def __init__(self, name: str, maxsize: int = 0, policy: str = DROP_OLDEST):
+        if policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown overflow policy %r" % policy)
+        self.name = name
+        self.policy = policy
+        self.high_water = 0
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize)
+
+    @property
+    def maxsize(self) -> int:
+        return self._queue.maxsize
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def put(self, item, block: bool = False):
+        """Add an item.  With block, wait for room whatever the policy."""
+        if self._queue.full():
+            if self.policy == BLOCK or block:
+                if self.high_water < self._queue.maxsize:
+                    _LOGGER.warning("Tap %s is full (%d items), blocking" % (self.name, self._queue.maxsize))
+                    self.high_water = self._queue.maxsize
+                await self._queue.put(item)
+                return
+            self.dropped += 1
+            if self.dropped & (self.dropped - 1) == 0:
+                _LOGGER.warning("Tap %s is full, %d items dropped so far" % (self.name, self.dropped))
+            if self.policy == DROP_NEWEST:
+                return
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+        depth = self._queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+    async def get(self):
+        return await self._queue.get()
+
+    def stats(self) -> dict:
+        """Current depth, high water mark and drop count"""
+        return {"name": self.name, "depth": self.depth, "maxsize": self.maxsize, "policy": self.policy,
+                "high_water": self.high_water, "dropped": self.dropped}
@@ -12,6 +12,7 @@ import discord
 import spam
 import time
 import isodate
+import misc
 from misc import inicap, trimiso
 import logging
 
@@ -211,14 +212,14 @@ def _rebuild_scores():
     _DB.commit()
 
     tsbreak = (datetime.datetime.now() - datetime.timedelta(days=60)).isoformat()
-    while True:
-        _logger.info("Rebuilding from beyond "+tsbreak)
-        kills = _query("WHERE timestamp > ? ORDER BY timestamp LIMIT 200", (tsbreak,))
-        if not kills:
-            break
-        for kill in kills:
-            tsbreak = kill.timestamp
-            _update_scores(kill)
+    _logger.info("Rebuilding from beyond "+tsbreak)
+    # Fetched all at once rather than paged by timestamp, since kill timestamps aren't unique.
+    kills = _query("WHERE timestamp > ? ORDER BY timestamp, rowid", (tsbreak,))
+    for i, kill in enumerate(kills):
+        _update_scores(kill, commit=False)
+        if (i+1) % 10000 == 0:
+            _logger.info("Rebuilt %d of %d kills" % (i+1, len(kills)))
+    _DB.commit()
 
 
 class Kill(object):
@@ -260,6 +261,12 @@ def _insert(kill: Kill):
     _DB.commit()
 
 
+def _exists(kill: Kill) -> bool:
+    """Determine whether a kill is already in the database"""
+    return _count("WHERE timestamp==? AND winner==? AND loser==? AND zone==?",
+                  (kill.timestamp, kill.winner, kill.loser, kill.zone)) > 0
+
+
 def _count(clause: str, *args) -> int:
     """Execute a count query against the kills table with a specified set of clauses"""
     cursor = _DB.cursor()
@@ -351,7 +358,7 @@ def _kill_value(kill: Kill):
     return winner_score, loser_score, value
 
 
-def _update_scores(kill: Kill):
+def _update_scores(kill: Kill, commit: bool = True):
     """Update scores to reflect a win."""
     ws, ls, value = _kill_value(kill)
     ws = ws + value
@@ -360,7 +367,8 @@ def _update_scores(kill: Kill):
     _DB.execute("INSERT INTO score_history (timestamp, player, score) VALUES (?,?,?)", (kill.timestamp, kill.winner, ws))
     _DB.execute("INSERT OR REPLACE INTO scores (player, score) VALUES (?,?)", (kill.loser, ls))
     _DB.execute("INSERT INTO score_history (timestamp, player, score) VALUES (?,?,?)", (kill.timestamp, kill.loser, ls))
-    _DB.commit()
+    if commit:
+        _DB.commit()
     return value
 
 
@@ -380,25 +388,30 @@ async def _announce(kill: Kill, value: int):
     e.add_field(name="`%s`" % inicap(kill.loser),
                 value="Kills: %d\nDeaths: %d\nStreak: %d\nScore: %d\nRank: %d" % _stats(kill.loser),
                 inline=True)
-    await spam.send(embed=e)
+    await spam.send(embed=e, dedup="kill|%s|%s|%s" % (kill.timestamp, kill.winner, kill.loser))
 
 
 _PVP_RE = re.compile(r"\[PvP] ([A-Za-z]+) <([^>]*)> has been defeated by ([A-Za-z]+) <([^>]*)> in ([^!]+)!")
 
 
 async def _on_kill(kill: Kill):
+    if _exists(kill):
+        # Replayed from the log after a restart, and already counted.
+        _logger.info("Ignoring already recorded kill %r" % kill)
+        return
     value = _update_scores(kill)
     _insert(kill)
-    asyncio.ensure_future(_announce(kill, value))
+    await _announce(kill, value)
 
 
 async def _pvp_loop():
     """Watch for kills and update the database"""
-    with eqlog.tap() as lt:
+    # Kills mustn't be dropped, so the log waits for us rather than the other way around.
+    with eqlog.tap([_PVP_RE], "pvp", policy=misc.BLOCK) as lt:
         while True:
-            m = _PVP_RE.match(await lt.next_line())
+            event, m = await lt.next_match()
             if m:
-                kill = Kill(datetime.datetime.now().isoformat(),
+                kill = Kill(event.timestamp.isoformat(),
                             m.group(3), m.group(4),
                             m.group(1), m.group(2),
                             m.group(5))
@@ -3,23 +3,82 @@
 import asyncio
 import chat
 import discord
-import dbm
+import json
+import logging
 import os
 import os.path
+import sqlite3
+import state
+import time
 
-_servermap = dbm.open(os.path.join(os.environ["HOME"], "r99infospam.db"), "c")
+_logger = logging.getLogger("spam")
+
+# Server id -> name of the bound channel.
+_servermap = state.table("spam", lambda: state.dbm_items(os.path.join(os.environ["HOME"], "r99infospam.db"),
+                                                         lambda value: str(value, "utf8")))
 
 
 async def init():
-    asyncio.ensure_future(_sync_db())
+    state.init()
+    asyncio.ensure_future(_prune_loop())
 
+# Server id -> id of the bound channel there, kept up to date from Discord's events.
+_INDEX = {}
+
+
+def _resolve(server):
+    """Find a server's bound channel by name, and note it in the index"""
+    _INDEX.pop(server.id, None)
+    if server.id not in _servermap:
+        return
+    channame = _servermap[server.id]
+    for channel in server.channels:
+        if channel.name == channame:
+            _INDEX[server.id] = channel.id
+            break
+    _sync_drainers()
+
+
+@chat.listen("on_ready")
+def _on_ready():
+    _INDEX.clear()
+    servers = chat.get_servers()
+    for server in servers:
+        _resolve(server)
+    present = set(server.id for server in servers)
+    for server_id in list(_servermap.keys()):
+        if server_id not in present:
+            _logger.info("Forgetting the spam channel of server %s, which we're no longer in" % server_id)
+            del _servermap[server_id]
+    _sync_drainers()
+
+
+@chat.listen("on_server_join")
+def _on_server_join(server):
+    _resolve(server)
+
+
+@chat.listen("on_server_remove")
+def _on_server_remove(server):
+    _INDEX.pop(server.id, None)
+    if server.id in _servermap:
+        _logger.info("Forgetting the spam channel of server %s, which we've left" % server.id)
+        del _servermap[server.id]
+    _sync_drainers()
+
+
+@chat.listen("on_channel_create")
+@chat.listen("on_channel_delete")
+def _on_channel_change(channel):
+    if getattr(channel, "server", None) is not None:
+        _resolve(channel.server)
+
+
+@chat.listen("on_channel_update")
+def _on_channel_update(before, after):
+    if getattr(after, "server", None) is not None:
+        _resolve(after.server)
 
-async def _sync_db():
-    global _servermap
-    while True:
-        _servermap.close()
-        _servermap = dbm.open(os.path.join(os.environ["HOME"], "r99infospam.db"), "c")
-        await asyncio.sleep(5)
 
 _SPAM_CATEGORY = "Spam management"
 
@@ -29,6 +88,8 @@ async def bind(msg):
     """(admin) Have the bot place all of its messages in the channel the command was sent in"""
     if msg.author.server_permissions.administrator:
         _servermap[msg.server.id] = msg.channel.name
+        _INDEX[msg.server.id] = msg.channel.id
+        _sync_drainers()
         chat.fade(await chat.send_info(msg.channel, "`bind`", "Sending spam to this channel"))
     else:
         chat.fade(await chat.send_error(msg.channel, "`bind`", "You are not a server administrator, "+msg.author.mention))
@@ -40,27 +101,195 @@ async def unbind(msg):
     if msg.author.server_permissions.administrator:
         if msg.server.id in _servermap:
             del _servermap[msg.server.id]
+        _INDEX.pop(msg.server.id, None)
+        _sync_drainers()
         chat.fade(await chat.send_info(msg.channel, "`unbind`", "No longer sending bot spam to this server"))
     else:
         chat.fade(await chat.send_error(msg.channel, "`unbind`", "You are not a server administrator, "+msg.author.mention))
 
 
-async def send(*args, **kwargs):
-    """Send a message/embed/etc to all spam channels."""
-    dead_ids = []
-    for idbytes in _servermap.keys():
-        server_id = str(idbytes, "utf8")
-        channame = str(_servermap[server_id], "utf8")
-        server = chat.get_server(server_id)
-        if server is None:
-            dead_ids.append(server_id)
-            continue
-        for channel in server.channels:
-            if channel.name == channame:
-                await chat.send_message(channel, *args, **kwargs)
-                break
-        else:
-            dead_ids.append(server_id)
-    for server_id in dead_ids:
-        print("deleting "+server_id)
-        del _servermap[server_id]
+_JOURNAL_FILENAME = os.path.join(os.environ["HOME"], "r99infooutbox.db")
+
+# Messages are remembered for this many seconds after they've been delivered, so that repeats of
+# them (e.g. log lines replayed after a restart) can be recognised by their dedup keys.
+DEDUP_WINDOW = 3600
+_PRUNE_INTERVAL = 300
+
+
+class _Journal(object):
+    """Append-only record of the messages for the spam channels, and of how far each channel has
+    got through it.  Kept in SQLite, so nothing is lost when the bot goes down."""
+
+    def __init__(self, filename: str):
+        self._db = sqlite3.connect(filename)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS outbox(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup TEXT UNIQUE,
+    created REAL NOT NULL,
+    content TEXT,
+    embed TEXT)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS acks(
+    channel_id CHAR(50) NOT NULL PRIMARY KEY,
+    last_id INT NOT NULL)""")
+        self._db.commit()
+
+    def append(self, content: str, embed: discord.Embed, dedup: str) -> bool:
+        """Add a message.  Returns False if it's a repeat."""
+        cursor = self._db.execute("INSERT OR IGNORE INTO outbox(dedup, created, content, embed) VALUES (?,?,?,?)",
+                                  (dedup, time.time(), content,
+                                   json.dumps(embed.to_dict()) if embed is not None else None))
+        self._db.commit()
+        return cursor.rowcount == 1
+
+    def last_id(self) -> int:
+        return self._db.execute("SELECT MAX(id) FROM outbox").fetchone()[0] or 0
+
+    def entries(self, after: int, limit: int) -> [tuple]:
+        """(id, content, embed) for messages after an id, in order"""
+        return self._db.execute("SELECT id, content, embed FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+                                (after, limit)).fetchall()
+
+    def acked(self, channel_id: str) -> int:
+        """The last message delivered to a channel, or None for a channel we haven't seen"""
+        row = self._db.execute("SELECT last_id FROM acks WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def ack(self, channel_id: str, last_id: int):
+        self._db.execute("INSERT OR REPLACE INTO acks(channel_id, last_id) VALUES (?,?)", (channel_id, last_id))
+        self._db.commit()
+
+    def forget(self, channel_id: str):
+        """Stop keeping track of a channel, so that it starts afresh if it's bound again"""
+        self._db.execute("DELETE FROM acks WHERE channel_id = ?", (channel_id,))
+        self._db.commit()
+
+    def prune(self, channel_ids: [str]):
+        """Forget messages every channel has had, once they're too old to be repeated"""
+        floor = self.last_id()
+        for channel_id in channel_ids:
+            acked = self.acked(channel_id)
+            if acked is not None:
+                floor = min(floor, acked)
+        self._db.execute("DELETE FROM outbox WHERE id <= ? AND created < ?", (floor, time.time() - DEDUP_WINDOW))
+        self._db.commit()
+
+
+_JOURNAL = _Journal(_JOURNAL_FILENAME)
+
+
+async def _prune_loop():
+    while True:
+        await asyncio.sleep(_PRUNE_INTERVAL)
+        _JOURNAL.prune(list(_DRAINERS))
+
+
+# Text sent to the spam channels within this many seconds of each other goes out as one message.
+BATCH_WINDOW = 1.0
+_MESSAGE_LIMIT = 2000
+_DRAIN_BATCH = 100
+# Failed sends are retried after 2, 4, 8... seconds, up to this long between tries.
+_MAX_BACKOFF = 60
+
+
+def _compose(entries: [tuple]):
+    """Make the next message from the front of the journal: as many text entries as fit in one
+    message, or a single embed.  Returns the id of the last entry used, and send_message's
+    keyword arguments."""
+    upto, content, embed = entries[0]
+    if embed is not None:
+        return upto, {"content": content, "embed": discord.Embed.from_data(json.loads(embed))}
+    lines = [content[:_MESSAGE_LIMIT]]
+    length = len(lines[0])
+    for entry_id, content, embed in entries[1:]:
+        if embed is not None or length + 1 + len(content) > _MESSAGE_LIMIT:
+            break
+        lines.append(content)
+        length += 1 + len(content)
+        upto = entry_id
+    return upto, {"content": "\n".join(lines)}
+
+
+class _Drainer(object):
+    """Delivers the journal to one spam channel, in order and at least once, picking up where it
+    left off after a restart.  A channel seen for the first time starts with new messages."""
+
+    def __init__(self, channel_id: str):
+        self.channel_id = channel_id
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        last = _JOURNAL.acked(self.channel_id)
+        if last is None:
+            last = _JOURNAL.last_id()
+            _JOURNAL.ack(self.channel_id, last)
+        failures = 0
+        try:
+            while True:
+                entries = _JOURNAL.entries(last, _DRAIN_BATCH)
+                if not entries:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    # Let whatever else is coming arrive, so that it goes out together.
+                    await asyncio.sleep(BATCH_WINDOW)
+                    continue
+                channel = chat.get_channel(self.channel_id)
+                if channel is None:
+                    # Not connected, or the channel's gone; we'll be stopped if it's for good.
+                    await asyncio.sleep(5)
+                    continue
+                upto, message = _compose(entries)
+                try:
+                    await chat.deliver_message(channel, **message)
+                except chat.SendError as e:
+                    if not e.permanent:
+                        # Discord's having trouble; keep the messages until it's over.
+                        failures += 1
+                        await asyncio.sleep(min(_MAX_BACKOFF, 2 ** failures))
+                        continue
+                    _logger.error("Skipping messages %d-%d to %s: %s" % (entries[0][0], upto, channel, e))
+                failures = 0
+                last = upto
+                _JOURNAL.ack(self.channel_id, last)
+        except asyncio.CancelledError:
+            pass
+
+
+_DRAINERS = {}
+
+
+def _sync_drainers():
+    """Have a drainer running for each bound channel, and no others"""
+    wanted = set(_INDEX.values())
+    for channel_id in list(_DRAINERS):
+        if channel_id not in wanted:
+            _DRAINERS.pop(channel_id).stop()
+            # Otherwise binding it again would send it everything queued in the meantime.
+            _JOURNAL.forget(channel_id)
+    for channel_id in wanted:
+        if channel_id not in _DRAINERS:
+            _DRAINERS[channel_id] = _Drainer(channel_id)
+
+
+def queue(content: str = None, embed: discord.Embed = None, dedup: str = None):
+    """Record a message for all spam channels, to be delivered in the background.  Plain text is
+    sent along with other text queued around the same time.  A message with the same dedup key as
+    one queued within the last DEDUP_WINDOW seconds is dropped."""
+    if content is None and embed is None:
+        return
+    if _JOURNAL.append(content, embed, dedup):
+        for drainer in _DRAINERS.values():
+            drainer.wake()
+
+
+async def send(content: str = None, embed: discord.Embed = None, dedup: str = None):
+    """Send a message/embed to all spam channels.  Returns as soon as it's recorded; see queue."""
+    queue(content, embed, dedup)
@@ -0,0 +1,183 @@
+# state.py: The bot's persistent state (spam bindings, watches, online states), in one SQLite
+# database.
+
+import asyncio
+import dbm
+import logging
+import os
+import pickle
+import shelve
+import sqlite3
+
+_logger = logging.getLogger("state")
+
+_FILENAME = os.path.join(os.environ["HOME"], "r99infostate.db")
+
+# How often changes are written out, in seconds.
+FLUSH_INTERVAL = 2
+
+
+class Table(object):
+    """A persistent dict, held in memory.  Setting a key to a value equal to what it already has
+    doesn't count as a change; real changes are written behind, together with every other
+    table's.  Values are replaced, not modified in place, so mutable values must be copied before
+    being changed."""
+
+    def __init__(self, store, name: str, rows):
+        self._store = store
+        self.name = name
+        self._data = dict((key, pickle.loads(value)) for key, value in rows)
+        self._dirty = set()
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        old = self._data.get(key, _MISSING)
+        self._data[key] = value
+        if old is _MISSING or old != value:
+            self._dirty.add(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._dirty.add(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def _changes(self):
+        """The writes needed to bring the database up to date: (key, pickled value or None)"""
+        return [(key, pickle.dumps(self._data[key]) if key in self._data else None) for key in self._dirty]
+
+
+_MISSING = object()
+
+
+class Store(object):
+    """One long-lived connection to the state database"""
+
+    def __init__(self, filename: str):
+        self._db = sqlite3.connect(filename)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS state(
+    tbl CHAR(50) NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY(tbl, key))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS imported(
+    tbl CHAR(50) NOT NULL PRIMARY KEY)""")
+        self._db.commit()
+        self._tables = []
+
+    def table(self, name: str, legacy=None) -> Table:
+        """Load a table.  The first time, legacy() is called for (key, value) pairs to fill it
+        with, e.g. from an older database."""
+        if legacy is not None and \
+                self._db.execute("SELECT 1 FROM imported WHERE tbl = ?", (name,)).fetchone() is None:
+            rows = [(name, key, pickle.dumps(value)) for key, value in legacy()]
+            self._db.executemany("INSERT OR REPLACE INTO state(tbl, key, value) VALUES (?,?,?)", rows)
+            self._db.execute("INSERT INTO imported(tbl) VALUES (?)", (name,))
+            self._db.commit()
+            if rows:
+                _logger.info("Imported %d %s entries" % (len(rows), name))
+        table = Table(self, name, self._db.execute("SELECT key, value FROM state WHERE tbl = ?", (name,)).fetchall())
+        self._tables.append(table)
+        return table
+
+    def flush(self):
+        """Write out every table's changes in one transaction"""
+        writes = 0
+        try:
+            for table in self._tables:
+                for key, value in table._changes():
+                    if value is None:
+                        self._db.execute("DELETE FROM state WHERE tbl = ? AND key = ?", (table.name, key))
+                    else:
+                        self._db.execute("INSERT OR REPLACE INTO state(tbl, key, value) VALUES (?,?,?)",
+                                         (table.name, key, value))
+                    writes += 1
+            if writes:
+                self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        for table in self._tables:
+            table._dirty.clear()
+
+    async def run(self):
+        """Write changes out periodically"""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                _logger.error("Couldn't save state", exc_info=True)
+
+
+_STORE = None
+
+
+def table(name: str, legacy=None) -> Table:
+    """Get a persistent table; see Store.table"""
+    global _STORE
+    if _STORE is None:
+        _STORE = Store(_FILENAME)
+    return _STORE.table(name, legacy)
+
+
+def flush():
+    """Write out all changes now, e.g. before exiting"""
+    if _STORE is not None:
+        _STORE.flush()
+
+
+def dbm_items(filename: str, decode=bytes):
+    """(key, value) pairs from an old dbm database, if there is one, for Store.table's legacy"""
+    try:
+        db = dbm.open(filename, "r")
+    except dbm.error:
+        return []
+    try:
+        return [(str(key, "utf8"), decode(db[key])) for key in db.keys()]
+    finally:
+        db.close()
+
+
+def shelve_items(filename: str):
+    """(key, value) pairs from an old shelve, if there is one, for Store.table's legacy"""
+    try:
+        db = shelve.open(filename, "r")
+    except dbm.error:
+        return []
+    try:
+        return list(db.items())
+    finally:
+        db.close()
+
+
+_is_init = False
+
+
+def init():
+    """Start writing changes out in the background"""
+    global _is_init
+    if _is_init or _STORE is None:
+        return
+    _is_init = True
+    asyncio.ensure_future(_STORE.run())
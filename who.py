@@ -1,9 +1,11 @@
 # who.py: Support for sending /who all commands to EQ
 
+import asyncio
+import collections
 import re
 import eqcmd
-import misc
 import chat
+import time
 
 CHAR_CATEGORY="Character presence"
 
@@ -17,7 +19,10 @@ async def _who_cmd(msg):
         whofilter = cmdparts[1]
     please_wait = await chat.send_warning(msg.channel, "`who %s`" % chat.quote(whofilter),
                                           "Please wait while I work on that, "+msg.author.mention)
-    wa = await who_all(whofilter)
+    try:
+        wa = await who_all(whofilter, eqcmd.INTERACTIVE, 30)
+    except eqcmd.CommandError:
+        wa = None
     if wa is None:
         await chat.send_error(msg.channel, "`who %s`" % chat.quote(whofilter), "Failed to execute /who command")
         if please_wait is not None:
@@ -93,23 +98,81 @@ _END_WHO = [
 ]
 
 
-async def who_all(text: str):
-    """Perform a /who all, and return a set of WhoEntry"""
-    with await eqcmd.tap() as ct:
-        return await _who_body(ct, text)
-
-
-@misc.timeout(10)
-async def _who_body(ct: eqcmd.CommandTap, text: str):
-    who = []
-    await ct.send("/who all " + text)
-    while True:
-        line = await ct.next_line()
-        p = parse_who(line)
-        if p:
-            who.append(p)
-        for filt in _END_WHO:
-            m = filt[0].match(line)
-            if m:
-                return who, filt[1](m)
-
+# How long, in seconds, a /who all result may be reused for the same query.
+CACHE_TTL = 5
+_CACHE_SIZE = 64
+_CACHE = collections.OrderedDict()
+_INFLIGHT = {}
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+async def who_all(text: str, priority: int = eqcmd.BACKGROUND, max_wait: float = None, max_age: float = CACHE_TTL):
+    """Perform a /who all, and return a set of WhoEntry.  A result up to max_age seconds old for
+    the same query may be returned instead, and concurrent identical queries share one /who, as
+    long as that doesn't make anybody wait longer than they asked to."""
+    key = _normalize(text)
+    cached = _CACHE.get(key)
+    if cached is not None and time.monotonic() - cached[0] <= max_age:
+        _CACHE.move_to_end(key)
+        return cached[1]
+
+    fut = _joinable(key, priority, max_wait)
+    if fut is None:
+        fut = asyncio.ensure_future(_who_uncached(key, priority, max_wait))
+        slot = key, priority
+        _INFLIGHT[slot] = None if max_wait is None else time.monotonic() + max_wait, fut
+        fut.add_done_callback(lambda f: _forget(slot, f))
+    # Shielded, so that one caller giving up doesn't cancel the query for everybody else.
+    return await asyncio.shield(fut)
+
+
+def _joinable(key: str, priority: int, max_wait: float):
+    """Find an in-flight query for key that's as urgent as one made now with priority and
+    max_wait: in the same or a more urgent priority class, and not due to give up any sooner."""
+    deadline = None if max_wait is None else time.monotonic() + max_wait
+    for (inflight_key, inflight_priority), (inflight_deadline, fut) in _INFLIGHT.items():
+        if inflight_key == key and inflight_priority <= priority and \
+                (inflight_deadline is None or deadline is not None and inflight_deadline >= deadline):
+            return fut
+    return None
+
+
+def _forget(slot: tuple, fut: asyncio.Future):
+    if slot in _INFLIGHT and _INFLIGHT[slot][1] is fut:
+        del _INFLIGHT[slot]
+
+
+def _confirmer(text: str):
+    """Tell whether a /who all response shows the filter was typed correctly.  Any answer won't do,
+    since a garbled filter usually just matches nobody; some player must match every word of it."""
+    words = [word for word in text.split() if word != "friends"]
+
+    def confirm(result) -> bool:
+        for we in result.items:
+            fields = " ".join(field for field in (we.classlevel, we.name, we.race, we.zone, we.guild)
+                              if field is not None).lower()
+            if all(word in fields for word in words):
+                return True
+        return False
+    return confirm
+
+
+async def _who_uncached(text: str, priority: int, max_wait: float):
+    result = await eqcmd.transact(eqcmd.Transaction("who", "/who all " + text,
+                                                    end=[filt[0] for filt in _END_WHO], collect=parse_who,
+                                                    timeout=10, priority=priority, max_wait=max_wait,
+                                                    confirm=_confirmer(text)))
+    if result is None:
+        return None
+    for pattern, count in _END_WHO:
+        if result.end.re is pattern:
+            result = result.items, count(result.end)
+            break
+    _CACHE[text] = time.monotonic(), result
+    _CACHE.move_to_end(text)
+    while len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return result